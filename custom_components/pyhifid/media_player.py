@@ -4,7 +4,7 @@ from __future__ import annotations
 import logging
 import voluptuous as vol
 
-from pyhifid.client import Client
+from pyhifid.client import Client, GroupClient
 
 from homeassistant.components.media_player import PLATFORM_SCHEMA, MediaPlayerEntity
 from homeassistant.components.media_player.const import (
@@ -34,10 +34,14 @@ SUPPORT_PYHIFID = (
 )
 
 DEFAULT_NAME = "pyhifid"
+CONF_MEMBERS = "members"
+CONF_OFFSETS = "offsets"
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
     {
         vol.Required(CONF_HOST): cv.string,
         vol.Optional(CONF_NAME, default=DEFAULT_NAME): cv.string,
+        vol.Optional(CONF_MEMBERS, default=[]): vol.All(cv.ensure_list, [cv.string]),
+        vol.Optional(CONF_OFFSETS, default={}): {cv.string: vol.Coerce(float)},
     }
 )
 
@@ -48,7 +52,14 @@ def setup_platform(
     discovery_info: DiscoveryInfoType | None = None,
 ) -> None:
     """Set up the pyhifid platform."""
-    pyhifid = PyhifidDevice(config[CONF_NAME], config[CONF_HOST])
+    if len(config[CONF_MEMBERS]) > 0:
+        pyhifid = PyhifidGroup(
+            config[CONF_NAME],
+            [config[CONF_HOST]] + config[CONF_MEMBERS],
+            config[CONF_OFFSETS],
+        )
+    else:
+        pyhifid = PyhifidDevice(config[CONF_NAME], config[CONF_HOST])
     pyhifid.update()
     add_entities([pyhifid])
 
@@ -125,3 +136,57 @@ class PyhifidDevice(MediaPlayerEntity):
 
     def select_sound_mode(self, sound_mode):
         self._client.set_output(sound_mode)
+
+
+class PyhifidGroup(PyhifidDevice):
+    """
+    Several pyhifid instances controlled as one, e.g. for multi-room
+    listening. The first one (host) is the leader whose volume and output
+    are shown; commands go to every member at once.
+    """
+
+    def __init__(self, name, urls, offsets):
+        super().__init__(name, urls[0])
+        self._leader = urls[0]
+        self._client = GroupClient(urls, offsets=offsets)
+
+    def _check(self, results):
+        for url, error in GroupClient.failed(results).items():
+            _LOGGER.warning(f"{self._name}: {url} failed: {error}")
+        return GroupClient.succeeded(results)
+
+    def update(self):
+        states = self._check(self._client.state())
+        if len(states) == 0:
+            return False
+
+        leader = states.get(self._leader, next(iter(states.values())))
+        offset = self._client.offsets.get(self._leader, 0)
+        self._volume = min(max(leader["volume"] - offset, 0), 255)
+        self._output = leader["output"]
+        self._outputs = self._client.common_outputs()
+        self._muted = all(state["muted"] for state in states.values())
+        self._power = any(state["power"] for state in states.values())
+
+        return True
+
+    def turn_on(self):
+        self._check(self._client.turn_on())
+
+    def turn_off(self):
+        self._check(self._client.turn_off())
+
+    def mute_volume(self, mute):
+        self._check(self._client.mute(mute))
+
+    def set_volume_level(self, volume):
+        self._check(self._client.set_volume(volume * 255.0))
+
+    def volume_up(self):
+        self._check(self._client.adjust_volume(1))
+
+    def volume_down(self):
+        self._check(self._client.adjust_volume(-1))
+
+    def select_sound_mode(self, sound_mode):
+        self._check(self._client.set_output(sound_mode))
@@ -1,13 +1,98 @@
 #!/usr/bin/env python3
 
-from flask import Flask
+from flask import Flask, Request, Response, g, request
 from flask_restful import reqparse, Api, Resource
 from flask_restful import inputs
+from gevent import socket
 from gevent.pywsgi import WSGIServer
+import errno
+import math
+import os
+import stat
 import sys
+import time
+
+from pyhifid import capture
+from pyhifid import diagnostics
+from pyhifid.scheduler import SCHEDULER
+from pyhifid import telemetry
+from pyhifid import trace
 
 HIFI = None
 REMOTE_INFO = None
+ALLOCATIONS = None
+SLEEP_TIMER = None
+PROFILE_DIR = None
+PROFILE_HEADER = "X-Pyhifid-Profile"
+
+# Prefix for ETags, so that versions from a previous run of the daemon are
+# never mistaken for current ones
+EPOCH = f"{int(time.time() * 1000):x}"
+
+
+class APIRequest(Request):
+    @property
+    def json_body(self):
+        """
+        The body's JSON object, or None if it isn't one. Unlike request.json
+        this never fails, so form-encoded requests still parse.
+        """
+        body = self.get_json(silent=True)
+        return body if isinstance(body, dict) else None
+
+
+# PUT arguments may be given as a JSON object, form data or in the query
+BODY = ("json_body", "values")
+
+
+def finite(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("must be a finite number")
+    return value
+
+
+def parser(*args):
+    ret = reqparse.RequestParser()
+    for name, kwargs in args:
+        ret.add_argument(name, **kwargs)
+    return ret
+
+
+POWER_ARGS = parser(("power", dict(type=inputs.boolean, location=BODY)))
+MUTE_ARGS = parser(("muted", dict(type=inputs.boolean, location=BODY)))
+VOLUME_ARGS = parser(
+    ("volume", dict(type=float, location=BODY)),
+    ("adjust", dict(type=float, location=BODY)),
+)
+OUTPUT_ARGS = parser(("output", dict(location=BODY)))
+SLEEP_ARGS = parser(("sleep", dict(type=float, location=BODY)))
+HISTORY_ARGS = parser(
+    ("start", dict(type=finite, location="args")),
+    ("end", dict(type=finite, location="args")),
+    ("step", dict(type=finite, location="args")),
+    ("kind", dict(choices=list(telemetry.KINDS.keys()), location="args")),
+)
+TRACE_ARGS = parser(("last", dict(type=int, location="args")))
+MEMORY_ARGS = parser(
+    ("limit", dict(type=int, default=20, location="args")),
+    (
+        "key",
+        dict(
+            choices=["lineno", "filename", "traceback"],
+            default="lineno",
+            location="args",
+        ),
+    ),
+    ("diff", dict(type=inputs.boolean, location="args")),
+    ("reset", dict(type=inputs.boolean, location="args")),
+)
+
+# Longest sleep timer accepted, in seconds
+MAX_SLEEP = 24 * 60 * 60
+
+# The backend's outputs, which don't change while it runs
+OUTPUTS = frozenset()
 
 
 class Power(Resource):
@@ -15,13 +100,15 @@ class Power(Resource):
         return {"power": HIFI.is_on()}
 
     def put(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument("power", type=inputs.boolean)
-        args = parser.parse_args()
+        with trace.span("parse"):
+            args = POWER_ARGS.parse_args()
 
         if args.power is None:
             return {"error": "invalid param"}, 400
 
+        if args.power == HIFI.is_on():
+            return self.get()
+
         if args.power:
             HIFI.turn_on()
         else:
@@ -35,13 +122,14 @@ class Mute(Resource):
         return {"muted": HIFI.muted()}
 
     def put(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument("muted", type=inputs.boolean)
-        args = parser.parse_args()
+        with trace.span("parse"):
+            args = MUTE_ARGS.parse_args()
 
         if args.muted is None:
             return {"error": "invalid param"}, 400
-        HIFI.mute(args.muted)
+
+        if args.muted != HIFI.muted():
+            HIFI.mute(args.muted)
 
         return self.get()
 
@@ -51,18 +139,24 @@ class Volume(Resource):
         return {"volume": HIFI.get_volume()}
 
     def put(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument("volume")
-        parser.add_argument("adjust")
-        args = parser.parse_args()
+        with trace.span("parse"):
+            args = VOLUME_ARGS.parse_args()
 
         if args.volume is None and args.adjust is None:
             return {"error": "invalid param"}, 400
 
+        current = HIFI.get_volume()
         if args.volume is not None:
-            HIFI.set_volume(float(args.volume))
+            if not 0 <= args.volume <= 255:
+                return {"error": "volume out of range"}, 400
+            if args.volume != current:
+                HIFI.set_volume(args.volume)
         else:
-            HIFI.adjust_volume(float(args.adjust))
+            if not math.isfinite(args.adjust):
+                return {"error": "invalid param"}, 400
+            # Adjustments are clamped, so one past either end does nothing
+            if min(max(current + args.adjust, 0), 255) != current:
+                HIFI.adjust_volume(args.adjust)
 
         return self.get()
 
@@ -75,14 +169,17 @@ class Output(Resource):
         }
 
     def put(self):
-        parser = reqparse.RequestParser()
-        parser.add_argument("output")
-        args = parser.parse_args()
+        with trace.span("parse"):
+            args = OUTPUT_ARGS.parse_args()
 
         if args.output is None:
             return {"error": "invalid param"}, 400
 
-        HIFI.set_output(args.output)
+        if args.output not in OUTPUTS:
+            return {"error": "unknown output"}, 400
+
+        if args.output != HIFI.get_output():
+            HIFI.set_output(args.output)
 
 
 class Remotes(Resource):
@@ -91,19 +188,233 @@ class Remotes(Resource):
         return { "remotes": info }
 
 
+class RemoteHistory(Resource):
+    def get(self, addr):
+        args = HISTORY_ARGS.parse_args()
+
+        if args.step is not None and args.step <= 0:
+            return {"error": "invalid param"}, 400
+
+        history = REMOTE_INFO.history(
+            addr, start=args.start, end=args.end, kind=args.kind, step=args.step
+        )
+        if history is None:
+            return {"error": "unknown remote"}, 404
+
+        return {"history": history}
+
+
+class Schedule(Resource):
+    def get(self):
+        return {
+            "scheduled": [
+                {"name": h.name, "remaining": h.remaining()}
+                for h in SCHEDULER.pending()
+            ]
+        }
+
+
+class Sleep(Resource):
+    def get(self):
+        if SLEEP_TIMER is None or not SLEEP_TIMER.active():
+            return {"sleep": None}
+        return {"sleep": SLEEP_TIMER.remaining()}
+
+    def put(self):
+        global SLEEP_TIMER
+
+        with trace.span("parse"):
+            args = SLEEP_ARGS.parse_args()
+
+        if args.sleep is None or not math.isfinite(args.sleep):
+            return {"error": "invalid param"}, 400
+        if not 0 <= args.sleep <= MAX_SLEEP:
+            return {"error": "sleep out of range"}, 400
+
+        if SLEEP_TIMER is not None:
+            SLEEP_TIMER.cancel()
+            SLEEP_TIMER = None
+
+        # 0 just cancels the timer
+        if args.sleep > 0:
+            SLEEP_TIMER = SCHEDULER.call_later(args.sleep, HIFI.turn_off, name="sleep")
+
+        return self.get()
+
+
 class BrutefirGraph(Resource):
     def get(self):
         return (HIFI.brutefir_graph(), {'Content-Type': 'text/plain'})
 
 
-def serve_api(hifi, remote_info, debug=False):
+class RelayWear(Resource):
+    def get(self):
+        return {"wear": HIFI.relay_wear()}
+
+
+class DebugTrace(Resource):
+    def get(self):
+        args = TRACE_ARGS.parse_args()
+        return {"trace": trace.RECORDER.dump(last=args.last)}
+
+
+class DebugMemory(Resource):
+    def get(self):
+        args = MEMORY_ARGS.parse_args()
+
+        if args.diff:
+            allocations = ALLOCATIONS.diff(args.limit, args.key, reset=args.reset)
+        else:
+            allocations = ALLOCATIONS.top(args.limit, args.key)
+        return {"memory": diagnostics.memory(), "allocations": allocations}
+
+
+class DebugThreads(Resource):
+    def get(self):
+        threads = diagnostics.threads()
+        greenlets = diagnostics.greenlets()
+        return {
+            "thread_count": len(threads),
+            "greenlet_count": len(greenlets),
+            "threads": threads,
+            "greenlets": greenlets,
+        }
+
+
+class DebugHandles(Resource):
+    def get(self):
+        return diagnostics.handles()
+
+
+def hifi_version():
+    return HIFI.version
+
+
+def remote_version():
+    return REMOTE_INFO.version
+
+
+# GET responses of these endpoints only change when their version does
+VERSIONS = {
+    "power": hifi_version,
+    "mute": hifi_version,
+    "volume": hifi_version,
+    "output": hifi_version,
+    "brutefirgraph": hifi_version,
+    "remotes": remote_version,
+    "remotehistory": remote_version,
+}
+
+
+def check_etag():
+    version = VERSIONS.get(request.endpoint)
+    if request.method != "GET" or version is None:
+        return None
+    g.etag = f"{EPOCH}-{version()}"
+    if request.if_none_match.contains(g.etag):
+        response = Response(status=304)
+        response.set_etag(g.etag)
+        return response
+    return None
+
+
+def add_etag(response):
+    if g.get("etag") is not None and response.status_code == 200:
+        response.set_etag(g.etag)
+    return response
+
+
+def begin_profile():
+    g.start = time.perf_counter()
+    if PROFILE_DIR is None and request.headers.get(PROFILE_HEADER) is None:
+        return
+    g.trace = trace.begin(f"{request.method} {request.path}")
+
+
+def end_profile(response):
+    args = dict(request.values.to_dict(), **(request.json_body or {}))
+    trace.RECORDER.add(
+        f"{request.method} {request.path}",
+        g.start,
+        time.perf_counter(),
+        {"status": response.status_code, "args": args},
+    )
+    capture.write("api", g.start, m=request.method, p=request.path, a=args)
+
+    if g.get("trace") is None:
+        return response
+
+    t = trace.end()
+    t.add("request", t.start, time.perf_counter(), {})
+    if request.headers.get(PROFILE_HEADER) is not None:
+        response.headers["Server-Timing"] = t.server_timing()
+    if PROFILE_DIR is not None:
+        name = f"{t.wall_start:.6f}-{request.method}-{request.path.strip('/')}"
+        t.dump(os.path.join(PROFILE_DIR, name.replace("/", "_") + ".json"))
+    return response
+
+
+def remove_stale_socket(path):
+    """
+    Remove the socket at path if nothing is listening on it any more. Raises
+    if path is something other than a socket, or a live one.
+    """
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise RuntimeError(f"{path} exists and is not a socket")
+    except FileNotFoundError:
+        return
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, f"{path} is in use by another process")
+
+
+def unix_listener(path, mode):
+    # Only replace a stale socket, never whatever else the path names
+    remove_stale_socket(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Bind under a umask which already gives no more access than mode, so
+    # the socket is never more permissive than intended
+    umask = os.umask(0o777 & ~mode)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    os.chmod(path, mode)
+    sock.listen()
+    return sock
+
+
+def create_app(hifi, remote_info, profile_dir=None, allocations=None):
     global HIFI
     HIFI = hifi
 
     global REMOTE_INFO
     REMOTE_INFO = remote_info
 
+    global PROFILE_DIR
+    PROFILE_DIR = profile_dir
+
+    global ALLOCATIONS
+    ALLOCATIONS = allocations
+
+    global OUTPUTS
+    OUTPUTS = frozenset(hifi.get_outputs())
+
     app = Flask("pyhifid")
+    app.request_class = APIRequest
+    app.before_request(begin_profile)
+    app.before_request(check_etag)
+    app.after_request(add_etag)
+    app.after_request(end_profile)
     api = Api(app)
 
     api.add_resource(Power, "/power")
@@ -111,7 +422,37 @@ def serve_api(hifi, remote_info, debug=False):
     api.add_resource(Volume, "/volume")
     api.add_resource(Output, "/output")
     api.add_resource(Remotes, "/remotes")
+    api.add_resource(RemoteHistory, "/remotes/<string:addr>/history")
+    api.add_resource(Schedule, "/schedule")
+    api.add_resource(Sleep, "/sleep")
     api.add_resource(BrutefirGraph, "/brutefir_graph")
-
-    server = WSGIServer(("", 4664), app, log=sys.stderr if debug else None)
+    api.add_resource(RelayWear, "/relays/wear")
+    api.add_resource(DebugTrace, "/debug/trace")
+    if allocations is not None:
+        api.add_resource(DebugMemory, "/debug/memory")
+        api.add_resource(DebugThreads, "/debug/threads")
+        api.add_resource(DebugHandles, "/debug/handles")
+
+    return app
+
+
+def serve_api(
+    hifi,
+    remote_info,
+    debug=False,
+    profile_dir=None,
+    unix_socket=None,
+    unix_socket_mode=0o660,
+    allocations=None,
+):
+    app = create_app(
+        hifi, remote_info, profile_dir=profile_dir, allocations=allocations
+    )
+    log = sys.stderr if debug else None
+
+    if unix_socket is not None:
+        listener = unix_listener(unix_socket, unix_socket_mode)
+        WSGIServer(listener, app, log=log).start()
+
+    server = WSGIServer(("", 4664), app, log=log)
     server.serve_forever()
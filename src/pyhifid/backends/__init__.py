@@ -1,4 +1,13 @@
 BACKENDS = {
     "MockHiFi": "pyhifid.backends.mock_hifi.MockHiFi",
     "PhirePreamp": "pyhifid.backends.phire_preamp.PhirePreamp",
+    "SimulatedPhirePreamp": "pyhifid.backends.sim.preamp.SimulatedPhirePreamp",
+}
+
+# Backends for use from an asyncio event loop; any of the above can also be
+# wrapped in pyhifid.hifi.SyncHiFiAdapter
+ASYNC_BACKENDS = {
+    "MockHiFi": "pyhifid.backends.mock_hifi.AsyncMockHiFi",
+    "PhirePreamp": "pyhifid.backends.phire_preamp.AsyncPhirePreamp",
+    "SimulatedPhirePreamp": "pyhifid.backends.sim.preamp.AsyncSimulatedPhirePreamp",
 }
@@ -1,5 +1,5 @@
 import logging
-from pyhifid.hifi import HiFi
+from pyhifid.hifi import AsyncHiFi, HiFi
 
 class MockHiFi(HiFi):
     def __init__(self):
@@ -61,3 +61,48 @@ class MockHiFi(HiFi):
 
     def brutefir_graph(self):
         return ""
+
+    def relay_wear(self):
+        return {}
+
+
+class AsyncMockHiFi(AsyncHiFi):
+    def __init__(self):
+        super().__init__()
+        self.hifi = MockHiFi()
+
+    def __getattr__(self, name):
+        return getattr(self.hifi, name)
+
+    def get_outputs(self):
+        return self.hifi.get_outputs()
+
+    async def set_output(self, output):
+        self.hifi.set_output(output)
+
+    def get_output(self):
+        return self.hifi.get_output()
+
+    async def set_volume(self, level):
+        self.hifi.set_volume(level)
+
+    def get_volume(self):
+        return self.hifi.get_volume()
+
+    async def adjust_volume(self, adjustment):
+        self.hifi.adjust_volume(adjustment)
+
+    async def mute(self, muted):
+        self.hifi.mute(muted)
+
+    def muted(self):
+        return self.hifi.muted()
+
+    async def turn_on(self):
+        self.hifi.turn_on()
+
+    async def turn_off(self):
+        self.hifi.turn_off()
+
+    def is_on(self):
+        return self.hifi.is_on()
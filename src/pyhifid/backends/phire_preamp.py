@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 
+import asyncio
+import copy
+import json
 import time
 
-from pyhifid.hifi import HiFi
-from pyhifid.backends.utils.gpio import Gpio
+from pyhifid.hifi import AsyncHiFi, HiFi
+from pyhifid.backends.utils.gpio import Gpio, find_lines, line_index
+from pyhifid.backends.utils.wear import DEFAULT_PATH as DEFAULT_WEAR_FILE
+from pyhifid.backends.utils.wear import WearCounters, open_counters
+from pyhifid.scheduler import SCHEDULER
+from pyhifid.trace import record, span, TracedLock
 from brutefir import BruteFIR
-from threading import Lock, Timer
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import logging
 import gpiod
 
@@ -31,15 +39,89 @@ class Relay:
 
 
 def get_linebulk(lines):
-    for chip in gpiod.ChipIter():
-        try:
-            bulk = chip.find_lines(lines)
-            _LOGGER.debug("found chip! " + str(bulk))
-            return bulk
-        except Exception as e:
-            _LOGGER.debug(str(e))
+    bulk = find_lines(lines)
+    _LOGGER.debug("found lines: " + str(bulk))
+    return bulk
 
-    raise RuntimeError("couldn't find gpio chip for lines: " + str(lines))
+
+# Settle delays, in seconds, for each step of a relay board operation:
+#  delta1: power_on: relay supply up before driving coils
+#          reset: after driving reset coils, before driving set coils
+#          set: coil drive time before releasing the lines
+#          release: after releasing the lines, before dropping the supply
+#  delta2: break: after driving relays off
+#          make: after driving relays on
+DEFAULT_RELAY_TIMING = {
+    "delta1": {"power_on": 0.015, "reset": 0.003, "set": 0.015, "release": 0.015},
+    "delta2": {"break": 0.015, "make": 0.015},
+}
+
+
+def load_relay_timing(path=None):
+    """
+    Load a relay timing profile from a JSON file, falling back to the default
+    delays for anything the profile doesn't specify
+    """
+    timing = copy.deepcopy(DEFAULT_RELAY_TIMING)
+    if path is None:
+        return timing
+
+    with open(path, "r") as f:
+        profile = json.load(f)
+
+    for board, delays in profile.items():
+        if board not in timing:
+            raise RuntimeError(f"unknown relay board in timing profile: {board}")
+        for name, delay in delays.items():
+            if name not in timing[board]:
+                raise RuntimeError(f"unknown delay for {board}: {name}")
+            if delay < 0:
+                raise RuntimeError(f"invalid delay for {board}.{name}: {delay}")
+            timing[board][name] = float(delay)
+
+    return timing
+
+
+def settle(seconds):
+    with span("settle", seconds=seconds):
+        time.sleep(seconds)
+
+
+# Relay operations are written as generators which perform each step and
+# yield the settle delay before the next one, so the same sequence can be
+# driven by blocking sleeps or from an asyncio event loop.
+def run_steps(steps):
+    for delay in steps:
+        settle(delay)
+
+
+class AsyncRelayLock:
+    """
+    asyncio lock shared by the boards on one relay supply, since a board
+    switching the supply off would cut short another board's pulse. The lock
+    is created on first use so that it belongs to the loop driving the boards.
+    """
+
+    def __init__(self):
+        self.lock = None
+
+    def get(self):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+
+async def async_run_steps(lock, steps):
+    async with lock.get():
+        for delay in steps:
+            with span("settle", seconds=delay):
+                await asyncio.sleep(delay)
+
+
+def async_run(board, steps):
+    # Shielded so that a cancelled caller can't leave a board half-switched
+    # with its relay supply on
+    return asyncio.shield(async_run_steps(board.async_lock, steps))
 
 
 def to_bitarray(x):
@@ -47,8 +129,19 @@ def to_bitarray(x):
 
 
 class AmbDelta1:
-    def __init__(self, pwr_gpio_name, prefix, relays=8):
-        self.lock = Lock()
+    def __init__(
+        self,
+        pwr_gpio_name,
+        prefix,
+        relays=8,
+        timing=None,
+        async_lock=None,
+        wear=None,
+    ):
+        self.lock = TracedLock(Lock(), "delta1_lock")
+        self.async_lock = async_lock or AsyncRelayLock()
+        self.wear = wear or WearCounters(boards=["delta1"]).board("delta1")
+        self.timing = dict(DEFAULT_RELAY_TIMING["delta1"], **(timing or {}))
         self.pwr_gpio = Gpio(pwr_gpio_name, direction=Gpio.OUTPUT)
 
         self._volume = 0
@@ -71,38 +164,69 @@ class AmbDelta1:
             return self._volume
 
     def set(self, volume, force=False):
+        with self.lock:
+            run_steps(self._set_steps(volume, force))
+
+    def async_set(self, volume, force=False):
+        """
+        Awaitable variant of set. A board should be driven either
+        synchronously or from a single event loop, not both at once.
+        """
+        return async_run(self, self._set_steps(volume, force))
+
+    def _set_steps(self, volume, force):
         _LOGGER.debug(f"{volume}, force: {force}")
 
         if volume > 255:
             raise RuntimeError("invalid volume level")
 
-        with self.lock:
-            mask = volume ^ self._volume
+        mask = volume ^ self._volume
+        if mask == 0 and not force:
+            # Already there; don't open a power window to switch nothing
+            return
 
-            if force:
-                mask = 0xFF
-                self._volume = 0xFF
+        if force:
+            mask = 0xFF
+            self._volume = 0xFF
 
+        with span("delta1_power_window", volume=volume):
             self.pwr_gpio.set(True)
-            time.sleep(0.015)
+            self.wear.power_window()
+            yield self.timing["power_on"]
 
+            record("delta1_frame", reset=self._volume & mask, set=volume & mask)
+            self.wear.mask(volume & mask, self._volume & mask)
             self.rst_lines.set_values(to_bitarray(self._volume & mask))
-            time.sleep(0.003)
+            yield self.timing["reset"]
             self.set_lines.set_values(to_bitarray(volume & mask))
-            time.sleep(0.015)
+            yield self.timing["set"]
 
             self.rst_lines.set_values(to_bitarray(0))
             self.set_lines.set_values(to_bitarray(0))
 
-            time.sleep(0.015)
+            yield self.timing["release"]
 
             self.pwr_gpio.set(False)
-            self._volume = volume
+        self._volume = volume
 
 
 class AmbDelta2:
-    def __init__(self, pwr_gpio_name, prefix, inputs=[], outputs=[]):
-        self.lock = Lock()
+    def __init__(
+        self,
+        pwr_gpio_name,
+        prefix,
+        inputs=[],
+        outputs=[],
+        timing=None,
+        break_before_make=True,
+        async_lock=None,
+        wear=None,
+    ):
+        self.lock = TracedLock(Lock(), "delta2_lock")
+        self.async_lock = async_lock or AsyncRelayLock()
+        self.wear = wear or WearCounters(boards=["delta2"]).board("delta2")
+        self.timing = dict(DEFAULT_RELAY_TIMING["delta2"], **(timing or {}))
+        self.break_before_make = break_before_make
 
         overlap = set(inputs) & set(outputs)
         if len(overlap) > 0:
@@ -111,39 +235,54 @@ class AmbDelta2:
         self.pwr_gpio = Gpio(pwr_gpio_name, direction=Gpio.OUTPUT)
 
         self.input = -1
+        self.input_ids = list(inputs)
         self.input_relays = []
         for i in inputs:
             set_gpio = Gpio(f"{prefix}SET_{i}", direction=Gpio.OUTPUT)
             rst_gpio = Gpio(f"{prefix}RST_{i}", direction=Gpio.OUTPUT)
             self.input_relays.append(Relay(set_gpio, rst_gpio))
 
+        # Output relays are driven as a single bulk: all of the set lines
+        # followed by all of the reset lines, so each step of a switch is one
+        # write.
         self.outputs = []
-        self.output_relays = []
-        for i in outputs:
-            set_gpio = Gpio(f"{prefix}SET_{i}", direction=Gpio.OUTPUT)
-            rst_gpio = Gpio(f"{prefix}RST_{i}", direction=Gpio.OUTPUT)
-            self.output_relays.append(Relay(set_gpio, rst_gpio))
+        self.output_ids = list(outputs)
+        self.num_outputs = len(outputs)
+        set_line_names = [f"{prefix}SET_{i}" for i in outputs]
+        rst_line_names = [f"{prefix}RST_{i}" for i in outputs]
+        self.output_lines = get_linebulk(set_line_names + rst_line_names)
+        self.output_lines.request(consumer="pyhifid", type=gpiod.LINE_REQ_DIR_OUT)
 
-        self.select_outputs([])
+        self.select_outputs([], force=True)
 
     def select_input(self, index):
+        with self.lock:
+            run_steps(self._select_input_steps(index))
+
+    def async_select_input(self, index):
+        return async_run(self, self._select_input_steps(index))
+
+    def _select_input_steps(self, index):
         if index < 0 or index > len(self.input_relays):
             raise RuntimeError("invalid input!")
 
-        with self.lock:
-            if index == self.input:
-                return
+        if index == self.input:
+            return
 
+        with span("delta2_power_window", input=index):
             self.pwr_gpio.set(True)
+            self.wear.power_window()
 
-            for relay in self.input_relays:
+            for i, relay in enumerate(self.input_relays):
                 relay.control(False)
+                self.wear.reset(self.input_ids[i])
 
-            time.sleep(0.015)
+            yield self.timing["break"]
 
             self.input_relays[index].control(True)
+            self.wear.set(self.input_ids[index])
 
-            time.sleep(0.015)
+            yield self.timing["make"]
 
             for relay in self.input_relays:
                 relay.reset()
@@ -152,31 +291,61 @@ class AmbDelta2:
 
             self.pwr_gpio.set(False)
 
-    def select_outputs(self, indices):
+    def _output_frame(self, on=[], off=[]):
+        return [1 if i in on else 0 for i in range(self.num_outputs)] + [
+            1 if i in off else 0 for i in range(self.num_outputs)
+        ]
+
+    def select_outputs(self, indices, force=False):
+        """
+        Switch the output relays so that exactly indices are on. Only relays
+        whose state changes are driven, unless force is set, in which case
+        every output relay is driven.
+        """
+        with self.lock:
+            run_steps(self._select_outputs_steps(indices, force))
+
+    def async_select_outputs(self, indices, force=False):
+        return async_run(self, self._select_outputs_steps(indices, force))
+
+    def _select_outputs_steps(self, indices, force):
         if type(indices) is not list:
             indices = [indices]
-        indices = sorted(indices)
+        indices = sorted(set(indices))
 
         for index in indices:
-            if index > len(self.output_relays):
+            if index < 0 or index >= self.num_outputs:
                 raise RuntimeError("invalid output!")
 
-        with self.lock:
-            if indices == self.outputs:
-                return
-
-            self.pwr_gpio.set(True)
+        if indices == self.outputs and not force:
+            return
 
-            for relay in self.output_relays:
-                relay.control(False)
+        current = self.outputs if not force else list(range(self.num_outputs))
+        on = [i for i in indices if force or i not in current]
+        off = [i for i in current if i not in indices]
 
-            time.sleep(0.015)
-
-            for index in indices:
-                self.output_relays[index].control(True)
-
-            time.sleep(0.015)
+        with span("delta2_power_window", outputs=indices):
+            self.pwr_gpio.set(True)
+            self.wear.power_window()
+            record("delta2_frame", on=on, off=off)
+            for i in on:
+                self.wear.set(self.output_ids[i])
+            for i in off:
+                self.wear.reset(self.output_ids[i])
+
+            if self.break_before_make and len(on) > 0 and len(off) > 0:
+                self.output_lines.set_values(self._output_frame(off=off))
+                yield self.timing["break"]
+                self.output_lines.set_values(self._output_frame(on=on))
+                yield self.timing["make"]
+            else:
+                self.output_lines.set_values(self._output_frame(on=on, off=off))
+                if len(on) > 0:
+                    yield self.timing["make"]
+                else:
+                    yield self.timing["break"]
 
+            self.output_lines.set_values(self._output_frame())
             self.outputs = indices
 
             self.pwr_gpio.set(False)
@@ -194,11 +363,12 @@ class LazyPower:
     the amount of time before the device is "on", and turn_off will
     power off the device after the grace period expires.
     """
-    def __init__(self, gpio, turn_on_delay, turn_off_grace):
+    def __init__(self, gpio, turn_on_delay, turn_off_grace, scheduler=SCHEDULER):
         self.gpio_name = gpio
         self.gpio = Gpio(gpio, direction=Gpio.OUTPUT)
         self.on_delay = turn_on_delay
         self.off_grace = turn_off_grace
+        self.scheduler = scheduler
         self.timer = None
 
         self.gpio.set(False)
@@ -206,11 +376,14 @@ class LazyPower:
     def turn_on(self):
         if self.timer is not None:
             _LOGGER.debug(f"LazyPower: {self.gpio} cancelling timer")
+            record("lazy_power_cancel_off", gpio=self.gpio_name)
             self.timer.cancel()
+            self.timer = None
 
         if not self.gpio.get():
             _LOGGER.info(f"LazyPower: {self.gpio} turning on")
-            self.gpio.set(True)
+            with span("lazy_power_on", gpio=self.gpio_name):
+                self.gpio.set(True)
             return self.on_delay
 
         return 0
@@ -218,25 +391,122 @@ class LazyPower:
     def turn_off(self):
         def deferred_off():
             _LOGGER.info(f"LazyPower: {self.gpio} turning off")
-            self.gpio.set(False)
+            with span("lazy_power_off", gpio=self.gpio_name):
+                self.gpio.set(False)
             self.timer = None
 
         if self.timer is None and self.gpio.get():
             _LOGGER.debug(f"LazyPower: {self.gpio} scheduling deferred off")
-            self.timer = Timer(self.off_grace, deferred_off)
-            self.timer.start()
+            with span("lazy_power_schedule_off", gpio=self.gpio_name):
+                self.timer = self.scheduler.call_later(
+                    self.off_grace, deferred_off, name=f"power_off {self.gpio_name}"
+                )
 
 
-class PhirePreamp(HiFi):
+def to_bool(val):
+    if type(val) is str:
+        return val.lower() in ["1", "true", "yes", "on"]
+    return bool(val)
+
+
+def timed(timings, name, fn, *args, **kwargs):
+    """
+    Call fn, recording how long it took in timings[name]
+    """
+    start = time.perf_counter()
+    with span(f"init_{name}"):
+        ret = fn(*args, **kwargs)
+    timings[name] = time.perf_counter() - start
+    return ret
+
+
+def create_relay_boards(timing=None, break_before_make=True, wear=None):
+    """
+    Create the Delta1 (volume) and Delta2 (input/output) boards of the preamp,
+    counting relay operations in wear (a WearCounters) if given
+    """
+    if timing is None:
+        timing = DEFAULT_RELAY_TIMING
+    if wear is None:
+        wear = WearCounters()
+
     # Delta2 outputs: 5 = headphones, 6 = stereo amp, 7 = subwoofer
-    def __init__(self):
+    async_lock = AsyncRelayLock()
+    delta1 = AmbDelta1(
+        "RELAY_PWR",
+        "DELTA1_",
+        timing=timing["delta1"],
+        async_lock=async_lock,
+        wear=wear.board("delta1"),
+    )
+    delta2 = AmbDelta2(
+        "RELAY_PWR",
+        "DELTA2_",
+        inputs=[0, 1, 2, 3, 4],
+        outputs=[5, 6, 7],
+        timing=timing["delta2"],
+        break_before_make=break_before_make,
+        async_lock=async_lock,
+        wear=wear.board("delta2"),
+    )
+    return delta1, delta2
+
+
+class PhirePreamp(HiFi):
+    def __init__(
+        self,
+        relay_timing=None,
+        break_before_make=True,
+        brutefir_host="127.0.0.1",
+        brutefir_port=6556,
+        wear_file=DEFAULT_WEAR_FILE,
+    ):
         super().__init__()
-        self.delta1 = AmbDelta1("RELAY_PWR", "DELTA1_")
-        self.delta2 = AmbDelta2(
-            "RELAY_PWR", "DELTA2_", inputs=[0, 1, 2, 3, 4], outputs=[5, 6, 7]
+        self.relay_timing = load_relay_timing(relay_timing)
+        # An empty wear_file keeps the counts in memory only
+        self.wear = open_counters(wear_file)
+
+        # The relay boards share a supply so are brought up one after the
+        # other, but in parallel with BruteFIR and the amp trigger.
+        self.init_timings = {}
+        start = time.perf_counter()
+        timed(self.init_timings, "gpio_scan", line_index)
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            relays = pool.submit(
+                timed,
+                self.init_timings,
+                "relay_boards",
+                create_relay_boards,
+                self.relay_timing,
+                break_before_make=to_bool(break_before_make),
+                wear=self.wear,
+            )
+            brutefir = pool.submit(
+                timed,
+                self.init_timings,
+                "brutefir",
+                BruteFIR,
+                host=brutefir_host,
+                port=int(brutefir_port),
+            )
+            amp_power = pool.submit(
+                timed,
+                self.init_timings,
+                "amp_power",
+                LazyPower,
+                "TRIG_OUT_0",
+                turn_on_delay=4.0,
+                turn_off_grace=120.0,
+            )
+            self.delta1, self.delta2 = relays.result()
+            self.brutefir = brutefir.result()
+            self.amp_power = amp_power.result()
+        self.init_timings["total"] = time.perf_counter() - start
+
+        _LOGGER.info(
+            "initialized in "
+            + ", ".join(f"{k}: {v * 1000:.1f} ms" for k, v in self.init_timings.items())
         )
-        self.brutefir = BruteFIR(host="127.0.0.1", port=6556)
-        self.amp_power = LazyPower("TRIG_OUT_0", turn_on_delay=4.0, turn_off_grace=120.0)
 
         self._is_on = False
         self._output = None
@@ -268,6 +538,11 @@ class PhirePreamp(HiFi):
                 "dirac",
             ]
         }
+        self.outputs = [
+            f"{output}:{coeff}"
+            for output, coeffs in self.output_coeffs.items()
+            for coeff in coeffs
+        ]
 
     def turn_on(self):
         with self.lock:
@@ -285,17 +560,14 @@ class PhirePreamp(HiFi):
         return self._is_on
 
     def get_outputs(self):
-        ret = []
-        for output, coeffs in self.output_coeffs.items():
-            for coeff in coeffs:
-                ret.append(f"{output}:{coeff}")
-        return ret
+        return list(self.outputs)
 
     def set_output(self, output_coeffs):
         output, coeffs = output_coeffs.split(":")
 
         with self.lock:
-            self.brutefir.change_filter_coeffs(coeffs)
+            with span("brutefir_change_filter_coeffs", coeffs=coeffs):
+                self.brutefir.change_filter_coeffs(coeffs)
             if output in ['speakers', 'no_sub']:
                 self.amp_power.turn_on()
             else:
@@ -328,7 +600,7 @@ class PhirePreamp(HiFi):
                 cur = 255
             if cur < 0:
                 cur = 0
-            print(f"cur: {cur} adj: {adjustment}")
+            _LOGGER.debug(f"cur: {cur} adj: {adjustment}")
             self.set_volume(cur)
 
     def mute(self, muted):
@@ -344,4 +616,95 @@ class PhirePreamp(HiFi):
         return self._muted
 
     def brutefir_graph(self):
-        return self.brutefir.graph()
+        with span("brutefir_graph"):
+            return self.brutefir.graph()
+
+    def relay_wear(self):
+        return self.wear.report()
+
+
+class AsyncPhirePreamp(AsyncHiFi):
+    """
+    PhirePreamp driven from an asyncio event loop, with the relay settle
+    delays awaited instead of slept. The wrapped preamp's relay boards
+    shouldn't be driven through its blocking methods at the same time.
+    """
+
+    def __init__(self, preamp=None, **kwargs):
+        super().__init__()
+        self.preamp = preamp if preamp is not None else PhirePreamp(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.preamp, name)
+
+    async def turn_on(self):
+        async with self.lock:
+            await self._set_output("none:dirac")
+            await self.set_volume(170)
+            self.preamp._is_on = True
+
+    async def turn_off(self):
+        async with self.lock:
+            await self._set_output("none:dirac")
+            await self.set_volume(0)
+            self.preamp._is_on = False
+
+    def is_on(self):
+        return self.preamp.is_on()
+
+    def get_outputs(self):
+        return self.preamp.get_outputs()
+
+    async def set_output(self, output_coeffs):
+        async with self.lock:
+            await self._set_output(output_coeffs)
+
+    async def _set_output(self, output_coeffs):
+        output, coeffs = output_coeffs.split(":")
+
+        # BruteFIR is on a local socket and answers well within a relay delay
+        with span("brutefir_change_filter_coeffs", coeffs=coeffs):
+            self.preamp.brutefir.change_filter_coeffs(coeffs)
+        if output in ["speakers", "no_sub"]:
+            self.preamp.amp_power.turn_on()
+        else:
+            self.preamp.amp_power.turn_off()
+
+        outputs = self.preamp.delta2_outputs[output]
+        if not self.preamp._muted:
+            await self.preamp.delta2.async_select_outputs(outputs)
+        self.preamp._d2_outputs = outputs
+        self.preamp._output = output_coeffs
+
+    def get_output(self):
+        return self.preamp.get_output()
+
+    def get_volume(self):
+        return self.preamp.get_volume()
+
+    async def set_volume(self, level):
+        await self.preamp.delta1.async_set(int(level))
+
+    async def adjust_volume(self, adjustment):
+        async with self.lock:
+            cur = min(max(self.get_volume() + adjustment, 0), 255)
+            await self.set_volume(cur)
+
+    async def mute(self, muted):
+        async with self.lock:
+            await self._mute(muted)
+
+    async def _mute(self, muted):
+        if muted:
+            self.preamp._muted = True
+            await self.preamp.delta2.async_select_outputs([])
+        else:
+            await self.preamp.delta2.async_select_outputs(self.preamp._d2_outputs)
+            self.preamp._muted = False
+
+    def muted(self):
+        return self.preamp.muted()
+
+    async def toggle_mute(self):
+        async with self.lock:
+            await self._mute(not self.muted())
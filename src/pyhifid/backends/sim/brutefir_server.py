@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for BruteFIR's CLI, good enough for the brutefir client
+library: it lists filters, inputs, outputs and coefficient sets in BruteFIR's
+format and accepts cfc/tmo/tmi/cfoa/cfia commands. Responses can be delayed,
+and a fraction of commands can be answered slowly or by dropping the
+connection.
+"""
+
+import logging
+import random
+import socket
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+WELCOME = 'Welcome to BruteFIR, type "help" for help.\n'
+PROMPT = "> "
+
+
+class BruteFIRServer:
+    def __init__(
+        self,
+        coeffs=["dirac", "speakers", "no_sub", "hd650", "dt770"],
+        channels=["l", "r"],
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        slow_rate=0.0,
+        slow_latency=1.0,
+        drop_rate=0.0,
+    ):
+        self.coeffs = list(coeffs)
+        self.channels = list(channels)
+        self.filter_coeffs = [0 for _ in self.channels]
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.drop_rate = drop_rate
+        self.random = random.Random()
+        self.lock = threading.Lock()
+        self.stats = {"connections": 0, "commands": 0, "slow": 0, "drops": 0}
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.listen()
+        self.host, self.port = self.socket.getsockname()
+
+        self.thread = threading.Thread(
+            target=self._accept, name="brutefir-sim", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _accept(self):
+        while True:
+            conn, _ = self.socket.accept()
+            self.stats["connections"] += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            conn.sendall((WELCOME + PROMPT).encode("ascii"))
+            f = conn.makefile("r", encoding="ascii", newline="\n")
+            for line in f:
+                self.stats["commands"] += 1
+
+                if self.latency > 0:
+                    time.sleep(self.latency)
+                if self.slow_rate > 0 and self.random.random() < self.slow_rate:
+                    self.stats["slow"] += 1
+                    time.sleep(self.slow_latency)
+                if self.drop_rate > 0 and self.random.random() < self.drop_rate:
+                    self.stats["drops"] += 1
+                    _LOGGER.debug("dropping connection")
+                    return
+
+                with self.lock:
+                    out = self._run(line.strip())
+                conn.sendall((out + PROMPT).encode("ascii"))
+
+    def _list_filters(self):
+        s = "Filters:\n"
+        for i, ch in enumerate(self.channels):
+            s += f'  {i}: "filter_{ch}"\n'
+            s += f"      coeff set: {self.filter_coeffs[i]}\n"
+            s += "      delay blocks: 0 (0 samples)\n"
+            s += f"      from inputs:  {i}/0.0\n"
+            s += f"      to outputs:   {i}/0.0\n"
+        return s
+
+    def _list_io(self, kind):
+        s = f"{kind}:\n"
+        for i, ch in enumerate(self.channels):
+            s += f'  {i}: "{kind.lower()}_{ch}" (delay: 0:0)\n'
+        return s
+
+    def _list_coeffs(self):
+        s = "Coefficient sets:\n"
+        for i, name in enumerate(self.coeffs):
+            s += f'  {i}: "{name}" (1 blocks)\n'
+        return s
+
+    def _run(self, line):
+        out = ""
+        for cmd in line.split(";"):
+            args = cmd.split()
+            if len(args) == 0:
+                continue
+            if args[0] == "lf":
+                out += self._list_filters()
+            elif args[0] == "li":
+                out += self._list_io("Inputs")
+            elif args[0] == "lo":
+                out += self._list_io("Outputs")
+            elif args[0] == "lc":
+                out += self._list_coeffs()
+            elif args[0] == "cfc" and len(args) == 3:
+                f, c = int(args[1]), int(args[2])
+                if f >= len(self.filter_coeffs) or c >= len(self.coeffs):
+                    out += "Invalid filter or coefficient set.\n"
+                else:
+                    self.filter_coeffs[f] = c
+            elif args[0] in ("tmo", "tmi", "cfoa", "cfia"):
+                pass
+            else:
+                out += "Unknown command.\n"
+        return out
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Simulated libgpiod (v1 python bindings) for the PhirePreamp boards.
+
+Only the parts of the API used by pyhifid are implemented. Lines carry the
+same names as the real hardware, plus some input lines which can be driven
+with find_line(name).drive(value). Every write can be delayed by a fixed
+latency, and the latching relays on the Delta1/Delta2 boards are modelled:
+a relay only switches if its coil is driven while RELAY_PWR has been up for
+power_settle seconds, and the coil is held for at least min_pulse seconds.
+"""
+
+import errno
+import os
+import random
+import sys
+import threading
+import time
+
+LINE_REQ_DIR_AS_IS = 1
+LINE_REQ_DIR_IN = 2
+LINE_REQ_DIR_OUT = 3
+LINE_REQ_EV_FALLING_EDGE = 4
+LINE_REQ_EV_RISING_EDGE = 5
+LINE_REQ_EV_BOTH_EDGES = 6
+
+EVENT_TYPES = (
+    LINE_REQ_EV_FALLING_EDGE,
+    LINE_REQ_EV_RISING_EDGE,
+    LINE_REQ_EV_BOTH_EDGES,
+)
+EVENT_EDGES = {1: LINE_REQ_EV_RISING_EDGE, 2: LINE_REQ_EV_FALLING_EDGE}
+
+POWER_LINE = "RELAY_PWR"
+
+
+class LineEvent:
+    RISING_EDGE = 1
+    FALLING_EDGE = 2
+
+    def __init__(self, type, source):
+        self.type = type
+        self.source = source
+        now = time.monotonic()
+        self.sec = int(now)
+        self.nsec = int((now - self.sec) * 1e9)
+
+
+class RelayModel:
+    """
+    A latching relay with set and reset coils
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.on = False
+        self.coil = None
+        self.coil_since = None
+        self.power_since = None
+        self.set_ops = 0
+        self.reset_ops = 0
+
+
+class Simulator:
+    """
+    State shared by every simulated chip and line
+    """
+
+    def __init__(
+        self, write_latency=0.0, fault_rate=0.0, power_settle=0.005, min_pulse=0.005
+    ):
+        self.lock = threading.RLock()
+        self.write_latency = write_latency
+        self.fault_rate = fault_rate
+        self.power_settle = power_settle
+        self.min_pulse = min_pulse
+        self.random = random.Random()
+
+        self.power_since = None
+        self.relays = {}
+        self.stats = {
+            "gpio_writes": 0,
+            "power_windows": 0,
+            "relay_ops": 0,
+            "short_pulses": 0,
+            "unpowered_drives": 0,
+            "coil_conflicts": 0,
+            "injected_faults": 0,
+        }
+
+    def relay(self, board, index):
+        key = (board, index)
+        if key not in self.relays:
+            self.relays[key] = RelayModel(f"{board}{index}")
+        return self.relays[key]
+
+    def maybe_fail(self, what):
+        if self.fault_rate > 0 and self.random.random() < self.fault_rate:
+            self.stats["injected_faults"] += 1
+            raise OSError(errno.EIO, f"simulated fault during {what}")
+
+    def _latch(self, relay, coil, end):
+        # Decide whether a coil drive which ended at `end` switched the relay
+        start = relay.coil_since
+        power_since = relay.power_since
+        relay.coil_since = None
+
+        if power_since is None:
+            self.stats["unpowered_drives"] += 1
+        elif end - max(start, power_since + self.power_settle) < self.min_pulse:
+            self.stats["short_pulses"] += 1
+        else:
+            self.stats["relay_ops"] += 1
+            if coil == "SET":
+                relay.set_ops += 1
+                relay.on = True
+            else:
+                relay.reset_ops += 1
+                relay.on = False
+
+    def write(self, line, value, delay=True):
+        if delay and self.write_latency > 0:
+            time.sleep(self.write_latency)
+
+        with self.lock:
+            self.stats["gpio_writes"] += 1
+            old = line.value
+            line.value = value
+            if old == value:
+                return
+
+            now = time.monotonic()
+            if line.name() == POWER_LINE:
+                if value:
+                    self.power_since = now
+                    self.stats["power_windows"] += 1
+                else:
+                    self.power_since = None
+                    for relay in self.relays.values():
+                        if relay.coil is not None and relay.coil_since is not None:
+                            self._latch(relay, relay.coil, now)
+                return
+
+            relay = line.relay
+            if relay is None:
+                return
+
+            if value:
+                if relay.coil is not None and relay.coil != line.coil:
+                    self.stats["coil_conflicts"] += 1
+                relay.coil = line.coil
+                relay.coil_since = now
+                relay.power_since = self.power_since
+            elif relay.coil == line.coil:
+                if relay.coil_since is not None:
+                    self._latch(relay, line.coil, now)
+                relay.coil = None
+
+    def relay_states(self, board):
+        return {
+            index: relay.on
+            for (b, index), relay in sorted(self.relays.items())
+            if b == board
+        }
+
+
+SIM = Simulator()
+
+
+class Line:
+    def __init__(self, chip, offset, name):
+        self.chip = chip
+        self._offset = offset
+        self._name = name
+        self.value = 0
+        self.consumer = None
+        self.type = None
+        self.events = None
+        self.relay = None
+        self.coil = None
+
+        # Relay coil lines look like DELTA1_SET_3 / DELTA2_RST_5
+        parts = name.split("_")
+        if len(parts) == 3 and parts[1] in ("SET", "RST"):
+            self.coil = parts[1]
+            self.relay = SIM.relay(parts[0] + "_", int(parts[2]))
+
+    def name(self):
+        return self._name
+
+    def offset(self):
+        return self._offset
+
+    def is_requested(self):
+        return self.consumer is not None
+
+    def request(self, consumer, type=LINE_REQ_DIR_AS_IS, default_val=None):
+        with SIM.lock:
+            if self.consumer is not None:
+                raise OSError(errno.EBUSY, f"{self._name} already requested")
+            SIM.maybe_fail(f"request of {self._name}")
+            self.consumer = consumer
+            self.type = type
+            if type in EVENT_TYPES:
+                self.events = os.pipe()
+        if default_val is not None:
+            self.set_value(default_val)
+
+    def release(self):
+        if self.events is not None:
+            for fd in self.events:
+                os.close(fd)
+            self.events = None
+        self.consumer = None
+
+    def get_value(self):
+        return self.value
+
+    def event_get_fd(self):
+        return self.events[0]
+
+    def event_read(self):
+        edge = os.read(self.events[0], 1)[0]
+        return LineEvent(edge, self)
+
+    def drive(self, value):
+        """
+        Drive an input line from outside, as a button or trigger would
+        """
+        value = int(value)
+        if value == self.value:
+            return
+        self.value = value
+        if self.events is None:
+            return
+        edge = LineEvent.RISING_EDGE if value else LineEvent.FALLING_EDGE
+        if self.type in (LINE_REQ_EV_BOTH_EDGES, EVENT_EDGES[edge]):
+            os.write(self.events[1], bytes([edge]))
+
+    def set_value(self, value, delay=True):
+        if self.consumer is None:
+            raise OSError(errno.EPERM, f"{self._name} not requested")
+        SIM.write(self, int(value), delay=delay)
+
+    def __repr__(self):
+        return f"Line({self.chip.name()}:{self._offset} {self._name})"
+
+
+class LineBulk:
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def to_list(self):
+        return list(self.lines)
+
+    def request(self, consumer, type=LINE_REQ_DIR_AS_IS, default_vals=None):
+        for line in self.lines:
+            line.request(consumer, type)
+        if default_vals is not None:
+            self.set_values(default_vals)
+
+    def release(self):
+        for line in self.lines:
+            line.release()
+
+    def get_values(self):
+        return [line.value for line in self.lines]
+
+    def set_values(self, values):
+        # A bulk write lands on all lines at once, so only pay the latency once
+        if SIM.write_latency > 0:
+            time.sleep(SIM.write_latency)
+        with SIM.lock:
+            for line, value in zip(self.lines, values):
+                line.set_value(value, delay=False)
+
+    def __repr__(self):
+        return f"LineBulk({self.lines})"
+
+
+class Chip:
+    def __init__(self, name, line_names):
+        self._name = name
+        self.lines = [Line(self, i, n) for i, n in enumerate(line_names)]
+
+    def name(self):
+        return self._name
+
+    def num_lines(self):
+        return len(self.lines)
+
+    def get_line(self, offset):
+        return self.lines[offset]
+
+    def get_lines(self, offsets):
+        return LineBulk([self.lines[o] for o in offsets])
+
+    def find_line(self, name):
+        for line in self.lines:
+            if line.name() == name:
+                return line
+        return None
+
+    def find_lines(self, names):
+        lines = [self.find_line(n) for n in names]
+        if None in lines:
+            raise OSError(errno.ENOENT, f"lines not found on {self._name}")
+        return LineBulk(lines)
+
+    def close(self):
+        pass
+
+
+def _relay_lines(prefix, relays=8):
+    return [f"{prefix}SET_{i}" for i in range(relays)] + [
+        f"{prefix}RST_{i}" for i in range(relays)
+    ]
+
+
+# Inputs for front panel buttons and triggers, driven with drive()
+INPUT_LINES = ["TRIG_IN_0", "AMP_READY"] + [f"BUTTON_{i}" for i in range(4)]
+
+CHIPS = [
+    Chip("gpiochip0", [POWER_LINE, "TRIG_OUT_0"] + _relay_lines("DELTA1_")),
+    Chip("gpiochip1", _relay_lines("DELTA2_")),
+    Chip("gpiochip2", INPUT_LINES),
+]
+
+
+def ChipIter():
+    return iter(CHIPS)
+
+
+def LineIter(chip):
+    return iter(chip.lines)
+
+
+def find_line(name):
+    for chip in CHIPS:
+        line = chip.find_line(name)
+        if line is not None:
+            return line
+    return None
+
+
+def install():
+    """
+    Make pyhifid's GPIO code use the simulated chips instead of libgpiod.
+    Must be called before the hardware backends are constructed.
+    """
+    module = sys.modules[__name__]
+    sys.modules["gpiod"] = module
+    for name in ["pyhifid.backends.utils.gpio", "pyhifid.backends.phire_preamp"]:
+        if name in sys.modules:
+            sys.modules[name].gpiod = module
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+from pyhifid.backends.sim import gpiod as sim_gpiod
+
+# The hardware modules import gpiod at import time, so the simulated chips
+# have to be in place before they're loaded.
+sim_gpiod.install()
+
+from pyhifid.backends.sim.brutefir_server import BruteFIRServer
+from pyhifid.backends.phire_preamp import AsyncPhirePreamp, PhirePreamp
+
+
+class SimulatedPhirePreamp(PhirePreamp):
+    """
+    PhirePreamp running its real relay, power and BruteFIR code paths against
+    simulated GPIO chips and a local BruteFIR stand-in.
+
+    Options may be passed as strings (e.g. via --backend_opt). GPIO faults are
+    only injected once the preamp has been initialized.
+    """
+
+    def __init__(
+        self,
+        relay_timing=None,
+        break_before_make=True,
+        gpio_latency=0.0,
+        gpio_fault_rate=0.0,
+        brutefir_latency=0.0,
+        brutefir_slow_rate=0.0,
+        brutefir_drop_rate=0.0,
+        seed=None,
+        wear_file=None,
+    ):
+        self.sim = sim_gpiod.SIM
+        self.sim.write_latency = float(gpio_latency)
+
+        self.brutefir_server = BruteFIRServer(
+            latency=float(brutefir_latency),
+            slow_rate=float(brutefir_slow_rate),
+            drop_rate=float(brutefir_drop_rate),
+        ).start()
+
+        if seed is not None:
+            self.sim.random.seed(int(seed))
+            self.brutefir_server.random.seed(int(seed))
+
+        super().__init__(
+            relay_timing=relay_timing,
+            break_before_make=break_before_make,
+            brutefir_host=self.brutefir_server.host,
+            brutefir_port=self.brutefir_server.port,
+            wear_file=wear_file,
+        )
+
+        self.sim.fault_rate = float(gpio_fault_rate)
+
+    def sim_stats(self):
+        return {
+            "gpio": dict(self.sim.stats),
+            "brutefir": dict(self.brutefir_server.stats),
+            "relays": {
+                relay.name: {"set": relay.set_ops, "reset": relay.reset_ops}
+                for relay in self.sim.relays.values()
+            },
+        }
+
+
+class AsyncSimulatedPhirePreamp(AsyncPhirePreamp):
+    def __init__(self, **kwargs):
+        super().__init__(preamp=SimulatedPhirePreamp(**kwargs))
@@ -8,9 +8,60 @@ Access to GPIOs via libgpiod
 """
 
 import contextlib
+import threading
+
 import gpiod
 
 
+_LINES = None
+_LINES_LOCK = threading.Lock()
+
+
+def line_index(rescan=False):
+    """
+    Returns a dict of line name to (chip, offset) for every named line,
+    scanning each chip only once
+    """
+    global _LINES
+    with _LINES_LOCK:
+        if _LINES is None or rescan:
+            lines = {}
+            for chip in gpiod.ChipIter():
+                for line in gpiod.LineIter(chip):
+                    name = line.name()
+                    if name is not None and name not in lines:
+                        lines[name] = (chip, line.offset())
+            _LINES = lines
+        return _LINES
+
+
+def find_line(name):
+    """
+    Look up a line by name, or return None if there isn't one
+    """
+    entry = line_index().get(name)
+    if entry is None:
+        return None
+    chip, offset = entry
+    return chip.get_line(offset)
+
+
+def find_lines(names):
+    """
+    Look up lines by name as a bulk; they must all be on the same chip
+    """
+    index = line_index()
+    missing = [name for name in names if name not in index]
+    if len(missing) > 0:
+        raise RuntimeError("failed to find gpios with names %s" % missing)
+
+    chips = {index[name][0] for name in names}
+    if len(chips) != 1:
+        raise RuntimeError("gpios %s are not all on the same chip" % names)
+
+    return chips.pop().get_lines([index[name][1] for name in names])
+
+
 @contextlib.contextmanager
 def request_gpio(line, direction):
     """
@@ -31,10 +82,12 @@ class Gpio:
     INPUT = gpiod.LINE_REQ_DIR_IN
     OUTPUT = gpiod.LINE_REQ_DIR_OUT
     FALLING_EDGE = gpiod.LINE_REQ_EV_FALLING_EDGE
+    RISING_EDGE = gpiod.LINE_REQ_EV_RISING_EDGE
+    BOTH_EDGES = gpiod.LINE_REQ_EV_BOTH_EDGES
 
     def __init__(self, name, direction=INPUT, default_val=None):
         self._direction = direction
-        self._line = gpiod.find_line(name)
+        self._line = find_line(name)
         self._out_value = False
         if self._line is None:
             raise RuntimeError("failed to find gpio with name %s" % name)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Relay wear counters: set and reset operations for every relay and the number
+of relay supply power windows for every board. They are kept in a small
+fixed-layout file which is memory-mapped, so counting an operation is a
+single store and the counts survive restarts. Dirty pages are written back
+every flush_interval seconds, so little is lost if power is cut.
+
+The file is a header (magic, version, number of boards, relays per board)
+followed by native-endian 64-bit counters; each board has its power window
+count followed by a set and a reset count for each relay.
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+from pyhifid.scheduler import SCHEDULER
+
+_LOGGER = logging.getLogger(__name__)
+
+MAGIC = b"PHRW"
+VERSION = 1
+HEADER = struct.Struct("=4sIII")
+
+BOARDS = ["delta1", "delta2"]
+
+# Where the daemon and pyhifid-calibrate keep their counters by default
+DEFAULT_PATH = "/var/lib/pyhifid/relay_wear"
+
+
+class BoardWear:
+    def __init__(self, counts, base):
+        self.counts = counts
+        self.base = base
+
+    def power_window(self):
+        self.counts[self.base] += 1
+
+    def set(self, relay):
+        self.counts[self.base + 1 + 2 * relay] += 1
+
+    def reset(self, relay):
+        self.counts[self.base + 2 + 2 * relay] += 1
+
+    def mask(self, set_mask, reset_mask):
+        """
+        Count the relays driven by a set and a reset bitmask
+        """
+        relay = 0
+        while set_mask or reset_mask:
+            if set_mask & 1:
+                self.set(relay)
+            if reset_mask & 1:
+                self.reset(relay)
+            set_mask >>= 1
+            reset_mask >>= 1
+            relay += 1
+
+
+class WearCounters:
+    """
+    Counters for the boards in BOARDS, stored at path, or only in memory if
+    path is None. An existing file at path which doesn't hold counters with
+    the same layout is left alone, and RuntimeError is raised.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        boards=BOARDS,
+        relays=8,
+        flush_interval=10.0,
+        scheduler=SCHEDULER,
+    ):
+        self.path = path
+        self.boards = list(boards)
+        self.relays = relays
+        self.stride = 1 + 2 * relays
+        size = HEADER.size + 8 * self.stride * len(self.boards)
+        header = HEADER.pack(MAGIC, VERSION, len(self.boards), relays)
+
+        if path is None:
+            self.mm = mmap.mmap(-1, size)
+            valid = False
+        else:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                # Check the file before changing it in any way
+                existing = os.fstat(fd).st_size
+                valid = existing > 0
+                if valid and (
+                    existing != size or os.pread(fd, HEADER.size, 0) != header
+                ):
+                    raise RuntimeError(
+                        f"{path} doesn't hold relay counters for {self.boards} "
+                        f"with {relays} relays; move it aside to start afresh"
+                    )
+                if not valid:
+                    os.ftruncate(fd, size)
+                self.mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+
+        if not valid:
+            self.mm[:] = bytes(size)
+            self.mm[: HEADER.size] = header
+
+        self.counts = memoryview(self.mm)[HEADER.size :].cast("Q")
+
+        self.flush_interval = flush_interval
+        self.scheduler = scheduler
+        if path is not None and flush_interval is not None:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        self.scheduler.call_later(
+            self.flush_interval, self._periodic_flush, name="wear flush"
+        )
+
+    def _periodic_flush(self):
+        self._schedule_flush()
+        # Only pages with new counts are written back
+        self.flush()
+
+    def board(self, name):
+        return BoardWear(self.counts, self.boards.index(name) * self.stride)
+
+    def flush(self):
+        self.mm.flush()
+
+    def report(self):
+        ret = {}
+        for i, name in enumerate(self.boards):
+            base = i * self.stride
+            ret[name] = {
+                "power_windows": self.counts[base],
+                "relays": {
+                    relay: {
+                        "set": self.counts[base + 1 + 2 * relay],
+                        "reset": self.counts[base + 2 + 2 * relay],
+                    }
+                    for relay in range(self.relays)
+                },
+            }
+        return ret
+
+
+def open_counters(path=DEFAULT_PATH):
+    """
+    Counters kept at path, creating its directory if need be, or only in
+    memory (and so reset on every restart) if path is empty or None
+    """
+    if not path:
+        return WearCounters()
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+    return WearCounters(path)
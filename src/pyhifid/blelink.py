@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+A non-blocking connection to a BLE peripheral, talking to bluepy's
+bluepy-helper process directly rather than through btle.Peripheral, whose
+calls all block on the helper's output (connecting, in particular, blocks for
+the whole connection attempt).
+
+The helper's output is read from its pipe with os.read() and split into lines
+here, so a select() on fileno() never misses lines which have already been
+read but not yet handled.
+"""
+
+import logging
+import os
+import subprocess
+import time
+
+from bluepy import btle
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class LinkError(Exception):
+    pass
+
+
+class BleLink:
+    """
+    Connection to the peripheral at addr. Call read() whenever fileno() is
+    readable; notifications are passed to on_notification(handle, data).
+    connected becomes True once the connection is up and notifications have
+    been enabled on the handles in notify.
+    """
+
+    def __init__(
+        self,
+        addr,
+        on_notification,
+        notify=(),
+        iface=None,
+        addr_type=btle.ADDR_TYPE_PUBLIC,
+        connect_timeout=10.0,
+    ):
+        self.addr = addr
+        self.on_notification = on_notification
+        self.notify = notify
+        self.connected = False
+        self.deadline = time.monotonic() + connect_timeout
+        self.buf = b""
+
+        args = [btle.helperExe]
+        if iface is not None:
+            args.append(str(iface))
+        self.proc = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+            start_new_session=True,
+        )
+        self.fd = self.proc.stdout.fileno()
+        os.set_blocking(self.fd, False)
+
+        if iface is not None:
+            self._write(f"conn {addr} {addr_type} hci{iface}")
+        else:
+            self._write(f"conn {addr} {addr_type}")
+
+    def fileno(self):
+        return self.fd
+
+    def _write(self, cmd):
+        try:
+            self.proc.stdin.write(cmd.encode() + b"\n")
+        except OSError as e:
+            raise LinkError(f"helper: {e}")
+
+    def read(self):
+        """
+        Handle whatever the helper has written. Raises LinkError if the
+        connection failed or was lost.
+        """
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        if data == b"":
+            raise LinkError("helper exited")
+
+        *lines, self.buf = (self.buf + data).split(b"\n")
+        for line in lines:
+            line = line.decode()
+            if line == "" or line.startswith("#"):
+                continue
+            self._handle(btle.BluepyHelper.parseResp(line))
+
+    def _handle(self, resp):
+        kind = resp["rsp"][0]
+        if kind in ("ntfy", "ind"):
+            self.on_notification(resp["hnd"][0], resp["d"][0])
+        elif kind == "stat":
+            state = resp["state"][0]
+            if state == "conn" and not self.connected:
+                for handle in self.notify:
+                    self._write(f"wr {handle:X} 0100")
+                self.connected = True
+            elif state == "disc":
+                raise LinkError("disconnected" if self.connected else "connect failed")
+        elif kind == "err":
+            raise LinkError(f"error from bluepy-helper ({resp['code'][0]})")
+
+    def close(self):
+        if self.proc.poll() is None:
+            try:
+                # The helper drops the connection when it exits
+                self._write("quit")
+            except LinkError:
+                pass
+            try:
+                self.proc.wait(timeout=0.5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
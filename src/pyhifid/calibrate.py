@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import shlex
+import subprocess
+import sys
+
+from pyhifid.backends.phire_preamp import create_relay_boards, load_relay_timing
+from pyhifid.backends.utils.wear import DEFAULT_PATH as DEFAULT_WEAR_FILE
+from pyhifid.backends.utils.wear import open_counters
+
+_LOGGER = logging.getLogger(__name__)
+
+# Volume levels which drive every Delta1 relay in both directions
+DELTA1_PATTERNS = [0x00, 0xFF, 0x55, 0xAA, 0x0F, 0xF0]
+
+# Output relay combinations (indices into the Delta2 output relays)
+DELTA2_PATTERNS = [[], [0, 1, 2], [0], [1, 2], [2], [0, 1]]
+
+
+class CommandVerifier:
+    """
+    Verification hook which runs an external command, e.g. one which reads
+    back the relay state through a test harness. The command is run as
+    `CMD <board> <expected state>` and must exit 0 if the board is in the
+    expected state.
+    """
+
+    def __init__(self, cmd):
+        self.cmd = shlex.split(cmd)
+
+    def __call__(self, board, state):
+        return subprocess.run(self.cmd + [board, state]).returncode == 0
+
+
+def exercise_delta1(delta1, pattern):
+    delta1.set(pattern)
+    return str(pattern)
+
+
+def resync_delta1(delta1):
+    delta1.set(0, force=True)
+
+
+def exercise_delta2(delta2, pattern):
+    delta2.select_outputs(pattern)
+    return ",".join(str(x) for x in sorted(pattern))
+
+
+def resync_delta2(delta2):
+    delta2.select_outputs([], force=True)
+
+
+BOARDS = {
+    "delta1": (exercise_delta1, resync_delta1, DELTA1_PATTERNS),
+    "delta2": (exercise_delta2, resync_delta2, DELTA2_PATTERNS),
+}
+
+
+def calibrate_delay(name, board, delay, verify, step, trials):
+    """
+    Shorten one of a board's delays by step until a trial fails verification.
+    Returns the shortest delay for which every trial passed.
+    """
+    exercise, resync, patterns = BOARDS[name]
+
+    best = board.timing[delay]
+    while best - step >= 0:
+        candidate = round(best - step, 6)
+        board.timing[delay] = candidate
+        _LOGGER.info(f"{name}.{delay}: trying {candidate * 1000:.1f} ms")
+
+        passed = True
+        for i in range(trials):
+            state = exercise(board, patterns[i % len(patterns)])
+            if not verify(name, state):
+                _LOGGER.info(f"{name}.{delay}: failed at {candidate * 1000:.1f} ms")
+                passed = False
+                break
+
+        if not passed:
+            break
+        best = candidate
+
+    board.timing[delay] = best
+    resync(board)
+    return best
+
+
+def calibrate(boards, verify, step=0.001, trials=24, margin=1.5):
+    """
+    Find the fastest relay timing profile which passes verification, for
+    each board in boards (a dict of board name to AmbDelta1/AmbDelta2).
+    Each delay is then padded by margin (but never above where it started).
+    """
+    profile = {}
+    for name, board in boards.items():
+        start = dict(board.timing)
+        BOARDS[name][1](board)
+        for delay in start:
+            calibrate_delay(name, board, delay, verify, step, trials)
+
+        profile[name] = {}
+        for delay, fastest in board.timing.items():
+            safe = max(fastest * margin, fastest + step)
+            profile[name][delay] = round(min(safe, start[delay]), 6)
+        board.timing.update(profile[name])
+
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the fastest safe relay timing for the PhirePreamp boards"
+    )
+    parser.add_argument(
+        "--verify",
+        required=True,
+        metavar="CMD",
+        help="command run as `CMD <board> <state>`; exits 0 if the relays settled",
+    )
+    parser.add_argument(
+        "--output", required=True, metavar="FILE", help="where to write the profile"
+    )
+    parser.add_argument(
+        "--start", metavar="FILE", help="profile to start from (default: built-in)"
+    )
+    parser.add_argument(
+        "--board", action="append", choices=list(BOARDS.keys()), default=[]
+    )
+    parser.add_argument("--step", type=float, default=0.001, help="step, in seconds")
+    parser.add_argument("--trials", type=int, default=24, help="trials per step")
+    parser.add_argument(
+        "--margin", type=float, default=1.5, help="safety factor applied to results"
+    )
+    parser.add_argument(
+        "--wear_file",
+        metavar="FILE",
+        default=DEFAULT_WEAR_FILE,
+        help="relay wear counters to add to (default: %(default)s, as used by "
+        + "the daemon); empty to not count",
+    )
+    parser.add_argument(
+        "--log", default="info", action="store", help="change log level"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log.upper())
+
+    timing = load_relay_timing(args.start)
+    wear = open_counters(args.wear_file)
+    delta1, delta2 = create_relay_boards(timing, wear=wear)
+    boards = {"delta1": delta1, "delta2": delta2}
+    if len(args.board) > 0:
+        boards = {k: v for k, v in boards.items() if k in args.board}
+
+    try:
+        profile = calibrate(
+            boards,
+            CommandVerifier(args.verify),
+            step=args.step,
+            trials=args.trials,
+            margin=args.margin,
+        )
+    finally:
+        wear.flush()
+
+    with open(args.output, "w") as f:
+        json.dump(profile, f, indent=4)
+    print(json.dumps(profile, indent=4))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Capture of the traffic driving the daemon (API requests and Powermate
+events), for playing back with pyhifid-replay. The capture is one line of
+compact JSON per entry:
+
+    {"t": seconds since the capture started, "k": kind, ...}
+
+where kind is "api" (m: method, p: path, a: arguments) or "powermate"
+(addr, e: callback name without the on_ prefix, a: callback arguments).
+The first line has kind "start" and the wall-clock start time.
+"""
+
+import json
+import threading
+import time
+
+_CAPTURE = None
+
+
+class Capture:
+    def __init__(self, path):
+        self.file = open(path, "w", buffering=1)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self._write({"t": 0.0, "k": "start", "wall": time.time()})
+
+    def _write(self, entry):
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def write(self, kind, t=None, **fields):
+        if t is None:
+            t = time.perf_counter()
+        self._write(dict({"t": round(t - self.start, 4), "k": kind}, **fields))
+
+
+def start(path):
+    global _CAPTURE
+    _CAPTURE = Capture(path)
+
+
+def write(kind, t=None, **fields):
+    """
+    Add an entry to the capture, if one is running. t is a perf_counter()
+    timestamp, defaulting to now.
+    """
+    if _CAPTURE is not None:
+        _CAPTURE.write(kind, t, **fields)
+
+
+def read(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip() != "":
+                yield json.loads(line)
@@ -1,22 +1,99 @@
 #!/usr/bin/env python3
 
 from pyhifid.hifi import HiFi
+from concurrent.futures import ThreadPoolExecutor
+import collections
 import requests
+import socket
 import sys
+import time
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+
+UNIX_PREFIX = "unix://"
+
+
+class UnixHTTPConnection(HTTPConnection):
+    def __init__(self, socket_path, *args, **kwargs):
+        super().__init__("localhost", *args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixHTTPConnectionPool(HTTPConnectionPool):
+    def __init__(self, socket_path, **kwargs):
+        super().__init__("localhost", **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixHTTPConnection(
+            self.socket_path, timeout=self.timeout.connect_timeout
+        )
+
+
+class UnixAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter which sends every request to a Unix domain socket
+    """
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = UnixHTTPConnectionPool(socket_path)
+
+    def get_connection(self, url, proxies=None):
+        return self.pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None, cert=None):
+        return self.pool
+
+    def close(self):
+        self.pool.close()
+        super().close()
 
 
 class Client(HiFi):
-    def __init__(self, url):
+    """
+    Client for a pyhifid instance. url is either an http:// URL or
+    unix:///path/to/socket for a daemon listening on a Unix domain socket.
+    """
+
+    def __init__(self, url, timeout=None):
         super().__init__()
-        self.url = url + "/"
+        self.timeout = timeout
+        self.session = requests.Session()
+        if url.startswith(UNIX_PREFIX):
+            self.url = "http://localhost/"
+            self.session.mount(self.url, UnixAdapter(url[len(UNIX_PREFIX) :]))
+        else:
+            self.url = url + "/"
+        # Last response for each GET without query parameters, keyed by URL,
+        # with its ETag. Queries (e.g. history since a given time) usually
+        # differ from call to call, so caching them would only grow this.
+        self.cache = {}
 
-    def _get(self, endpoint):
-        resp = requests.get(self.url + endpoint)
+    def _get(self, endpoint, params=None):
+        req = requests.Request("GET", self.url + endpoint, params=params)
+        url = req.prepare().url
+        cached = self.cache.get(url) if not params else None
+        headers = {"If-None-Match": cached[0]} if cached is not None else {}
+
+        resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and cached is not None:
+            return cached[1]
         resp.raise_for_status()
-        return resp.json()
+        data = resp.json()
+        if "ETag" in resp.headers and not params:
+            self.cache[url] = (resp.headers["ETag"], data)
+        return data
 
     def _put(self, endpoint, data):
-        resp = requests.put(self.url + endpoint, data=data)
+        resp = self.session.put(self.url + endpoint, data=data, timeout=self.timeout)
         resp.raise_for_status()
         return resp.json()
 
@@ -58,50 +135,334 @@ class Client(HiFi):
     def is_on(self):
         return self._get("power")["power"]
 
+    def state(self):
+        return {
+            "power": self.is_on(),
+            "muted": self.muted(),
+            "volume": self.get_volume(),
+            "output": self.get_output(),
+        }
+
+    def sleep(self, seconds):
+        """
+        Turn off after seconds; 0 cancels the sleep timer
+        """
+        self._put("sleep", data={"sleep": seconds})
+
+    def sleep_remaining(self):
+        return self._get("sleep")["sleep"]
+
+    def scheduled(self):
+        return self._get("schedule")["scheduled"]
+
     def remote_info(self):
         return self._get("remotes")["remotes"]
 
+    def relay_wear(self):
+        return self._get("relays/wear")["wear"]
+
+    def remote_history(self, addr, start=None, end=None, kind=None, step=None):
+        params = {"start": start, "end": end, "kind": kind, "step": step}
+        params = {k: v for k, v in params.items() if v is not None}
+        return self._get(f"remotes/{addr}/history", params=params)["history"]
+
+
+# Outcome of a group call on one member: value is the call's return value,
+# or error the exception it raised; elapsed is in seconds
+GroupResult = collections.namedtuple("GroupResult", ["value", "error", "elapsed"])
+
+
+class GroupClient:
+    """
+    Drives several pyhifid instances at once. Each call is sent to every
+    member concurrently and returns a dict of url -> GroupResult, so a member
+    which fails or times out doesn't stop the others. offsets is a dict of
+    url -> volume offset applied when setting the group volume.
+    """
+
+    def __init__(self, urls, offsets=None, timeout=5.0):
+        if len(urls) == 0:
+            raise ValueError("a group needs at least one member URL")
+        self.members = {url: Client(url, timeout=timeout) for url in urls}
+        self.offsets = offsets or {}
+        self.executor = ThreadPoolExecutor(max_workers=len(self.members))
+
+    def _run(self, fn, url, client):
+        start = time.perf_counter()
+        try:
+            value, error = fn(url, client), None
+        except Exception as e:
+            value, error = None, e
+        return GroupResult(value, error, time.perf_counter() - start)
+
+    def fan_out(self, fn):
+        """
+        Call fn(url, client) for every member concurrently
+        """
+        futures = {
+            url: self.executor.submit(self._run, fn, url, client)
+            for url, client in self.members.items()
+        }
+        return {url: f.result() for url, f in futures.items()}
+
+    def _call(self, method, *args):
+        return self.fan_out(lambda url, client: getattr(client, method)(*args))
+
+    @staticmethod
+    def succeeded(results):
+        return {url: r.value for url, r in results.items() if r.error is None}
+
+    @staticmethod
+    def failed(results):
+        return {url: r.error for url, r in results.items() if r.error is not None}
+
+    def get_outputs(self):
+        return self._call("get_outputs")
+
+    def common_outputs(self):
+        """
+        Outputs offered by every member which could be reached
+        """
+        outputs = list(self.succeeded(self.get_outputs()).values())
+        if len(outputs) == 0:
+            return []
+        return [o for o in outputs[0] if all(o in other for other in outputs[1:])]
+
+    def set_output(self, output):
+        return self._call("set_output", output)
+
+    def get_output(self):
+        return self._call("get_output")
+
+    def set_volume(self, level):
+        def set_volume(url, client):
+            member_level = min(max(level + self.offsets.get(url, 0), 0), 255)
+            client.set_volume(member_level)
+            return member_level
+
+        return self.fan_out(set_volume)
+
+    def get_volume(self):
+        return self._call("get_volume")
+
+    def adjust_volume(self, adjustment):
+        return self._call("adjust_volume", adjustment)
+
+    def mute(self, muted):
+        return self._call("mute", muted)
+
+    def muted(self):
+        return self._call("muted")
+
+    def turn_on(self):
+        return self._call("turn_on")
+
+    def turn_off(self):
+        return self._call("turn_off")
+
+    def is_on(self):
+        return self._call("is_on")
+
+    def toggle_mute(self):
+        return self._call("toggle_mute")
+
+    def state(self):
+        return self._call("state")
+
+    def sleep(self, seconds):
+        return self._call("sleep", seconds)
+
+    def sleep_remaining(self):
+        return self._call("sleep_remaining")
+
+    def scheduled(self):
+        return self._call("scheduled")
+
+    def remote_info(self):
+        return self._call("remote_info")
+
+    def relay_wear(self):
+        return self._call("relay_wear")
+
+    def remote_history(self, addr, start=None, end=None, kind=None, step=None):
+        return self._call("remote_history", addr, start, end, kind, step)
+
+
+class ControlClient(HiFi):
+    """
+    Client for the line-based control protocol (see pyhifid.control). url is
+    either tcp://host:port or unix:///path/to/socket. State notifications
+    received while waiting for replies are passed to on_notify(key, value).
+    """
+
+    def __init__(self, url, on_notify=None):
+        super().__init__()
+        self.on_notify = on_notify
+        if url.startswith(UNIX_PREFIX):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(url[len(UNIX_PREFIX) :])
+        else:
+            host, _, port = url[len("tcp://") :].rpartition(":")
+            self.sock = socket.create_connection((host, int(port)))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = b""
+
+    def close(self):
+        self.sock.close()
+
+    def _readline(self):
+        while b"\n" not in self.buf:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("connection closed")
+            self.buf += data
+        line, _, self.buf = self.buf.partition(b"\n")
+        return line.decode("utf-8")
+
+    def _read_reply(self):
+        while True:
+            line = self._readline()
+            if line.startswith("! "):
+                if self.on_notify is not None:
+                    key, _, value = line[2:].partition(" ")
+                    self.on_notify(key, value)
+                continue
+            if line.startswith("err "):
+                raise RuntimeError(line[4:])
+            return line[3:].partition(" ")[2]
+
+    def pipeline(self, cmds):
+        """
+        Send several commands at once and return their replies
+        """
+        self.sock.sendall("".join(cmd + "\n" for cmd in cmds).encode("utf-8"))
+        replies = []
+        error = None
+        for _ in cmds:
+            try:
+                replies.append(self._read_reply())
+            except RuntimeError as e:
+                replies.append(None)
+                error = e
+        if error is not None and len(cmds) == 1:
+            raise error
+        return replies
+
+    def command(self, cmd):
+        return self.pipeline([cmd])[0]
+
+    def wait_notification(self, timeout=None):
+        """
+        Wait for the next state notification; returns (key, value)
+        """
+        self.sock.settimeout(timeout)
+        try:
+            line = self._readline()
+        finally:
+            self.sock.settimeout(None)
+        key, _, value = line[2:].partition(" ")
+        return key, value
+
+    def get_outputs(self):
+        return self.command("l").split(" ")
+
+    def set_output(self, output):
+        self.command(f"o {output}")
+
+    def get_output(self):
+        return self.command("o")
+
+    def set_volume(self, level):
+        self.command(f"v {level}")
+
+    def adjust_volume(self, adjustment):
+        self.command(f"v {adjustment:+}")
+
+    def get_volume(self):
+        return float(self.command("v"))
+
+    def mute(self, muted):
+        self.command("m 1" if muted else "m 0")
+
+    def muted(self):
+        return self.command("m") == "1"
+
+    def toggle_mute(self):
+        self.command("m t")
+
+    def turn_on(self):
+        self.command("p 1")
+
+    def turn_off(self):
+        self.command("p 0")
+
+    def is_on(self):
+        return self.command("p") == "1"
+
+
+def is_group_result(value):
+    return isinstance(value, dict) and all(
+        isinstance(r, GroupResult) for r in value.values()
+    )
+
+
+def show(label, value):
+    if not is_group_result(value):
+        # Setters of a single Client return nothing
+        if value is not None:
+            print("%s: %s" % (label, str(value)))
+        return
+    for url, result in value.items():
+        if result.error is not None:
+            out = "error: %s" % str(result.error)
+        else:
+            out = str(result.value)
+        print("%s %s: %s (%.1f ms)" % (url, label, out, result.elapsed * 1000))
+
 
 def cli(hifi):
     def do_volume(args):
         if len(args) >= 2:
-            hifi.set_volume(int(args[1]))
+            show("volume", hifi.set_volume(int(args[1])))
         elif len(args) == 1:
-            print("volume: %f" % hifi.get_volume())
+            show("volume", hifi.get_volume())
         else:
             print("usage: volume [vol]")
 
     def do_output(args):
-        if len(args) >= 2:
+        if isinstance(hifi, GroupClient):
+            outputs = hifi.common_outputs()
+        else:
             outputs = hifi.get_outputs()
-            hifi.set_output(outputs[int(args[1])])
+        if len(args) >= 2:
+            show("output", hifi.set_output(outputs[int(args[1])]))
         elif len(args) == 1:
-            print("outputs: %s" % str(hifi.get_outputs()))
-            print("output: %s" % str(hifi.get_output()))
+            print("outputs: %s" % str(outputs))
+            show("output", hifi.get_output())
         else:
             print("usage: output [output]")
 
     def do_mute(args):
         if len(args) >= 2:
             if args[1] == "on":
-                hifi.mute(True)
+                show("mute", hifi.mute(True))
             elif args[1] == "off":
-                hifi.mute(False)
+                show("mute", hifi.mute(False))
             else:
                 print("usage: mute [on/off]")
         elif len(args) == 1:
-            print("mute: %s" % str(hifi.muted()))
+            show("mute", hifi.muted())
 
     def do_power(args):
         if len(args) >= 2:
             if args[1] == "on":
-                hifi.turn_on()
+                show("power", hifi.turn_on())
             elif args[1] == "off":
-                hifi.turn_off()
+                show("power", hifi.turn_off())
             else:
                 print("usage: power [on/off]")
         elif len(args) == 1:
-            print("power: %s" % str(hifi.is_on()))
+            show("power", hifi.is_on())
         else:
             print("usage: power [on/off]")
 
@@ -109,7 +470,17 @@ def cli(hifi):
         sys.exit(0)
 
     def do_remotes(args):
-        print(hifi.remote_info())
+        show("remotes", hifi.remote_info())
+
+    def do_sleep(args):
+        if len(args) >= 2:
+            show("sleep", hifi.sleep(float(args[1]) * 60))
+        else:
+            remaining = hifi.sleep_remaining()
+            show("sleep", "off" if remaining is None else remaining)
+
+    def do_state(args):
+        show("state", hifi.state())
 
     cmds = {
         "vol": do_volume,
@@ -120,6 +491,8 @@ def cli(hifi):
         "outputs": do_output,
         "power": do_power,
         "remotes": do_remotes,
+        "sleep": do_sleep,
+        "state": do_state,
         "quit": do_quit,
         "q": do_quit,
     }
@@ -140,8 +513,27 @@ def main():
     import argparse
 
     parser = argparse.ArgumentParser(description="pyhifid")
-    parser.add_argument("url", help="pyhifid instance url")
+    parser.add_argument(
+        "url",
+        nargs="+",
+        help="pyhifid instance url, or unix:///path/to/socket; "
+        + "with several, commands go to all of them at once",
+    )
+    parser.add_argument(
+        "--offset",
+        action="append",
+        default=[],
+        metavar="URL=N",
+        help="volume offset of a group member",
+    )
     args = parser.parse_args()
 
-    hifi = Client(args.url)
+    if len(args.url) == 1:
+        hifi = Client(args.url[0])
+    else:
+        offsets = {}
+        for opt in args.offset:
+            url, _, offset = opt.rpartition("=")
+            offsets[url] = float(offset)
+        hifi = GroupClient(args.url, offsets=offsets)
     cli(hifi)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Line-based control protocol for input devices (knobs, IR receivers, keypads).
+
+Each frame is a single line terminated by a newline. A command is a one
+letter resource, optionally followed by an argument:
+
+    v           query volume          v 120    set volume
+    v +2, v -1  adjust volume
+    m           query mute            m 1, m 0, m t   mute, unmute, toggle
+    p           query power           p 1, p 0, p t   on, off, toggle
+    o           query output          o NAME   select output
+    o +1, o -1  step through the outputs
+    l           list the outputs, separated by spaces
+    s           query everything
+    w 1, w 0    enable/disable state notifications (enabled by default)
+
+Every command gets exactly one reply, in order, so clients can pipeline:
+"ok <resource> <value>" or "err <message>". State changes, whatever caused
+them, are sent to every watching connection as "! <resource> <value>".
+Consecutive volume adjustments which arrive together are applied as one,
+with the same result as applying them one at a time.
+"""
+
+import collections
+import logging
+import math
+
+import gevent
+from gevent.server import StreamServer
+
+from pyhifid.api import unix_listener
+
+_LOGGER = logging.getLogger(__name__)
+
+KEYS = {"v": "volume", "m": "muted", "p": "power", "o": "output"}
+
+
+def format_value(value):
+    if type(value) is bool:
+        return "1" if value else "0"
+    if type(value) is float:
+        return f"{value:g}"
+    return str(value)
+
+
+def parse_bool(arg, current):
+    if arg == "t":
+        return not current
+    if arg in ("1", "0"):
+        return arg == "1"
+    raise ValueError(f"invalid value: {arg}")
+
+
+def parse_number(arg):
+    value = float(arg)
+    if not math.isfinite(value):
+        raise ValueError(f"invalid value: {arg}")
+    return value
+
+
+def is_adjust(line):
+    return line.startswith("v +") or line.startswith("v -")
+
+
+class Connection:
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.watch = True
+
+    def send(self, lines):
+        self.sock.sendall(("".join(line + "\n" for line in lines)).encode("utf-8"))
+
+    def handle(self):
+        buf = b""
+        while True:
+            data = self.sock.recv(4096)
+            if not data:
+                return
+            buf += data
+            *frames, buf = buf.split(b"\n")
+            lines = [f.decode("utf-8", "replace").strip() for f in frames]
+            # Replies go out before the notifications for the same changes
+            self.server.batches += 1
+            try:
+                replies = self.server.run_batch(self, [l for l in lines if l != ""])
+                self.send(replies)
+            finally:
+                self.server.batches -= 1
+                self.server.flush()
+
+
+class ControlServer:
+    """
+    Serves the control protocol on TCP and/or a Unix domain socket
+    """
+
+    def __init__(self, hifi, port=None, unix_socket=None, unix_socket_mode=0o660):
+        self.hifi = hifi
+        self.connections = set()
+        self.servers = []
+        if port is not None:
+            self.servers.append(StreamServer(("", port), self._handle))
+        if unix_socket is not None:
+            listener = unix_listener(unix_socket, unix_socket_mode)
+            self.servers.append(StreamServer(listener, self._handle))
+
+        # State changes can come from other threads (e.g. the Powermate loop)
+        # or other greenlets (e.g. API requests); queue them up and wake the
+        # hub to send them out. While a connection is running a batch, it
+        # sends them itself after its replies.
+        self.pending = collections.deque()
+        self.batches = 0
+        self.wakeup = gevent.get_hub().loop.async_()
+        self.wakeup.start(self._wake)
+        hifi.add_listener(self._state_changed)
+
+    def start(self):
+        for server in self.servers:
+            server.start()
+
+    def _handle(self, sock, address):
+        conn = Connection(self, sock)
+        self.connections.add(conn)
+        try:
+            conn.handle()
+        except OSError as e:
+            _LOGGER.debug(f"control connection closed: {e}")
+        finally:
+            self.connections.discard(conn)
+
+    def _state_changed(self, state, changed):
+        lines = [f"! {k} {format_value(state[k])}" for k in sorted(changed)]
+        self.pending.append(lines)
+        self.wakeup.send()
+
+    def _wake(self):
+        if self.batches == 0:
+            self.flush()
+
+    def flush(self):
+        while len(self.pending) > 0:
+            lines = self.pending.popleft()
+            for conn in list(self.connections):
+                if conn.watch:
+                    try:
+                        conn.send(lines)
+                    except OSError:
+                        self.connections.discard(conn)
+
+    def run_batch(self, conn, lines):
+        replies = []
+        i = 0
+        while i < len(lines):
+            # Merge a run of relative volume changes into a single adjustment.
+            # Adjustments are clamped to 0-255 one at a time, so the run
+            # stops before any step which would take the volume out of range
+            # (and so be clamped); merging never changes the result.
+            with self.hifi.lock:
+                j = i
+                adjust = 0.0
+                current = self.hifi.get_volume()
+                try:
+                    while j < len(lines) and is_adjust(lines[j]):
+                        step = parse_number(lines[j][2:])
+                        if not 0 <= current + adjust + step <= 255:
+                            break
+                        adjust += step
+                        j += 1
+                except ValueError:
+                    pass
+
+                if j - i > 1:
+                    try:
+                        self.hifi.adjust_volume(adjust)
+                        reply = f"ok volume {format_value(self.hifi.get_volume())}"
+                    except Exception as e:
+                        reply = f"err {e}"
+                    replies += [reply] * (j - i)
+                    i = j
+                    continue
+
+            replies.append(self.run(conn, lines[i]))
+            i += 1
+
+        return replies
+
+    def run(self, conn, line):
+        cmd, _, arg = line.partition(" ")
+        arg = arg.strip()
+        try:
+            if cmd == "s":
+                state = self.hifi.state()
+                return "ok state " + " ".join(
+                    f"{k}={format_value(v)}" for k, v in sorted(state.items())
+                )
+            if cmd == "l":
+                return "ok outputs " + " ".join(self.hifi.get_outputs())
+            if cmd == "w":
+                conn.watch = parse_bool(arg, conn.watch)
+                return f"ok watch {format_value(conn.watch)}"
+            if cmd not in KEYS:
+                return f"err unknown command: {cmd}"
+
+            if arg != "":
+                self._apply(cmd, arg)
+            return f"ok {KEYS[cmd]} {format_value(self._get(cmd))}"
+        except Exception as e:
+            return f"err {e}"
+
+    def _get(self, cmd):
+        if cmd == "v":
+            return self.hifi.get_volume()
+        if cmd == "m":
+            return self.hifi.muted()
+        if cmd == "p":
+            return self.hifi.is_on()
+        return self.hifi.get_output()
+
+    def _apply(self, cmd, arg):
+        if cmd == "v":
+            if arg[0] in "+-":
+                self.hifi.adjust_volume(parse_number(arg))
+            else:
+                level = parse_number(arg)
+                if level < 0 or level > 255:
+                    raise ValueError(f"invalid volume: {arg}")
+                self.hifi.set_volume(level)
+        elif cmd == "m":
+            with self.hifi.lock:
+                self.hifi.mute(parse_bool(arg, self.hifi.muted()))
+        elif cmd == "p":
+            with self.hifi.lock:
+                if parse_bool(arg, self.hifi.is_on()):
+                    self.hifi.turn_on()
+                else:
+                    self.hifi.turn_off()
+        elif cmd == "o":
+            with self.hifi.lock:
+                outputs = self.hifi.get_outputs()
+                if arg[0] in "+-":
+                    output = self.hifi.get_output()
+                    idx = outputs.index(output) if output in outputs else 0
+                    arg = outputs[(idx + int(arg)) % len(outputs)]
+                if arg not in outputs:
+                    raise ValueError(f"invalid output: {arg}")
+                self.hifi.set_output(arg)
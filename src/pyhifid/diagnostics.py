@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Runtime introspection for finding leaks in a long-running daemon: memory
+usage, tracemalloc statistics, live threads and greenlets, and open file
+descriptors. Nothing here is enabled unless the daemon is started with
+--diagnostics, since tracemalloc slows every allocation down.
+"""
+
+import gc
+import os
+import sys
+import threading
+import traceback
+import tracemalloc
+
+import greenlet
+
+
+def memory():
+    """
+    Returns the Vm* fields of /proc/self/status, in kB
+    """
+    ret = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key.startswith("Vm"):
+                ret[key] = int(value.split()[0])
+    return ret
+
+
+def _format_stat(stat):
+    return {
+        "where": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+        "size": stat.size,
+        "count": stat.count,
+    }
+
+
+def _format_diff(stat):
+    return dict(
+        _format_stat(stat), size_diff=stat.size_diff, count_diff=stat.count_diff
+    )
+
+
+class Allocations:
+    """
+    tracemalloc statistics, either the top allocators or the difference from
+    a baseline snapshot
+    """
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.baseline = None
+
+    def start(self):
+        tracemalloc.start(self.frames)
+        self.baseline = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = tracemalloc.take_snapshot()
+        return snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+
+    def top(self, limit=20, key="lineno"):
+        if not tracemalloc.is_tracing():
+            return None
+        stats = self._snapshot().statistics(key)
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            "traced": current,
+            "peak": peak,
+            "top": [_format_stat(s) for s in stats[:limit]],
+        }
+
+    def diff(self, limit=20, key="lineno", reset=False):
+        """
+        Compare against the baseline snapshot, which is taken when tracing
+        starts; if reset is set, the current snapshot becomes the new baseline
+        """
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.baseline, key)
+        if reset:
+            self.baseline = snapshot
+        return {"diff": [_format_diff(s) for s in stats[:limit]]}
+
+
+def threads():
+    frames = sys._current_frames()
+    ret = []
+    for t in threading.enumerate():
+        frame = frames.get(t.ident)
+        ret.append(
+            {
+                "name": t.name,
+                "ident": t.ident,
+                "daemon": t.daemon,
+                "stack": traceback.format_stack(frame) if frame is not None else [],
+            }
+        )
+    return ret
+
+
+def greenlets():
+    ret = []
+    for obj in gc.get_objects():
+        if not isinstance(obj, greenlet.greenlet) or obj.dead:
+            continue
+        frame = obj.gr_frame
+        ret.append(
+            {
+                "name": getattr(obj, "name", None) or type(obj).__name__,
+                "stack": traceback.format_stack(frame) if frame is not None else [],
+            }
+        )
+    return ret
+
+
+def _classify(target):
+    if target.startswith("socket:"):
+        return "socket"
+    if target.startswith("/dev/gpiochip"):
+        return "gpiochip"
+    if target.startswith("anon_inode:gpio") or target.startswith("anon_inode:[gpio"):
+        return "gpio_line"
+    if target.startswith("pipe:"):
+        return "pipe"
+    if target.startswith("anon_inode:"):
+        return "anon_inode"
+    return "file"
+
+
+def handles():
+    """
+    Returns the open file descriptors by type, e.g. GPIO line handles (each
+    requested line or bulk of lines holds one) and sockets
+    """
+    fds = {}
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            target = os.readlink(f"/proc/self/fd/{fd}")
+        except OSError:
+            # The fd used to list the directory is already closed
+            continue
+        fds.setdefault(_classify(target), []).append(
+            {"fd": int(fd), "target": target}
+        )
+    return {
+        "counts": {k: len(v) for k, v in fds.items()},
+        "fds": fds,
+    }
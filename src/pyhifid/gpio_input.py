@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+GPIO inputs (front panel buttons, trigger inputs, amp ready signals) mapped
+to HiFi actions. Every line is requested for edge events and all of them are
+waited on in a single epoll loop on one thread.
+
+Edges are debounced on the leading edge: a change is acted on immediately,
+further edges within the debounce period are ignored, and the line is read
+again once it has passed in case it settled somewhere else.
+"""
+
+import logging
+import select
+import threading
+import time
+
+from pyhifid.trace import record
+
+_LOGGER = logging.getLogger(__name__)
+
+VOLUME_STEP = 4
+
+
+def _power(hifi, active):
+    with hifi.lock:
+        if hifi.is_on():
+            hifi.turn_off()
+        else:
+            hifi.turn_on()
+
+
+def _power_follow(hifi, active):
+    if active:
+        hifi.turn_on()
+    else:
+        hifi.turn_off()
+
+
+def _mute(hifi, active):
+    hifi.toggle_mute()
+
+
+def _mute_follow(hifi, active):
+    hifi.mute(active)
+
+
+def _step_output(hifi, step):
+    with hifi.lock:
+        outputs = hifi.get_outputs()
+        output = hifi.get_output()
+        idx = outputs.index(output) if output in outputs else 0
+        hifi.set_output(outputs[(idx + step) % len(outputs)])
+
+
+# Action name -> (whether it follows the line in both directions rather than
+# acting on presses, function(hifi, active))
+ACTIONS = {
+    "power": (False, _power),
+    "power_on": (False, lambda hifi, active: hifi.turn_on()),
+    "power_off": (False, lambda hifi, active: hifi.turn_off()),
+    "power_follow": (True, _power_follow),
+    "mute": (False, _mute),
+    "mute_follow": (True, _mute_follow),
+    "volume_up": (False, lambda hifi, active: hifi.adjust_volume(VOLUME_STEP)),
+    "volume_down": (False, lambda hifi, active: hifi.adjust_volume(-VOLUME_STEP)),
+    "output_next": (False, lambda hifi, active: _step_output(hifi, 1)),
+    "output_prev": (False, lambda hifi, active: _step_output(hifi, -1)),
+    "log": (True, lambda hifi, active: None),
+}
+
+
+class InputLine:
+    def __init__(self, name, action, active_low, line):
+        self.name = name
+        self.action = action
+        self.active_low = active_low
+        self.line = line
+        self.value = None
+        self.quiet_until = 0.0
+        self.pending = False
+
+    def read(self):
+        return int(self.line.get_value()) ^ self.active_low
+
+
+class GpioInputs:
+    """
+    Watches input lines and runs the HiFi action mapped to each. Lines are
+    given as NAME=ACTION, with NAME prefixed by ! if the line is active low.
+    """
+
+    def __init__(self, hifi, debounce=0.02):
+        self.hifi = hifi
+        self.debounce = debounce
+        self.epoll = select.epoll()
+        self.lines = {}
+        self.thread = threading.Thread(
+            target=self._run, name="gpio-input", daemon=True
+        )
+
+    def add(self, spec):
+        # Imported here so that the daemon runs without libgpiod unless GPIO
+        # inputs are actually configured
+        import gpiod
+        from pyhifid.backends.utils.gpio import Gpio, find_line
+
+        self.rising_edge = gpiod.LineEvent.RISING_EDGE
+
+        name, sep, action = spec.partition("=")
+        if sep == "" or action not in ACTIONS:
+            raise RuntimeError(f"invalid gpio input: {spec}")
+
+        active_low = name.startswith("!")
+        name = name.lstrip("!")
+        line = find_line(name)
+        if line is None:
+            raise RuntimeError(f"failed to find gpio with name {name}")
+
+        # Both edges are needed even for presses, to debounce the release
+        line.request(consumer="pyhifid", type=Gpio.BOTH_EDGES)
+        input_line = InputLine(name, action, int(active_low), line)
+        input_line.value = input_line.read()
+
+        fd = line.event_get_fd()
+        self.lines[fd] = input_line
+        self.epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+        _LOGGER.info(f"gpio input {name}: {action}")
+
+    def start(self):
+        self.thread.start()
+
+    def _change(self, line, value, now):
+        line.quiet_until = now + self.debounce
+        line.pending = False
+        if value == line.value:
+            return
+        line.value = value
+
+        follow, fn = ACTIONS[line.action]
+        if not follow and not value:
+            return
+        record("gpio_input", line=line.name, action=line.action, value=value)
+        try:
+            fn(self.hifi, bool(value))
+        except Exception:
+            _LOGGER.exception(f"gpio input {line.name}: {line.action} failed")
+
+    def _event(self, line, now):
+        event = line.line.event_read()
+        value = int(event.type == self.rising_edge) ^ line.active_low
+        if now < line.quiet_until:
+            line.pending = True
+            return
+        self._change(line, value, now)
+
+    def _timeout(self, now):
+        deadlines = [l.quiet_until for l in self.lines.values() if l.pending]
+        if len(deadlines) == 0:
+            return -1
+        return max(min(deadlines) - now, 0.0)
+
+    def _run(self):
+        while True:
+            events = self.epoll.poll(self._timeout(time.monotonic()))
+            now = time.monotonic()
+            for fd, _ in events:
+                self._event(self.lines[fd], now)
+
+            for line in self.lines.values():
+                if line.pending and now >= line.quiet_until:
+                    self._change(line, line.read(), now)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 
-from threading import RLock
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock, Thread
+
+from pyhifid.trace import TracedLock
 
 
 class HiFi:
@@ -9,7 +13,7 @@ class HiFi:
     """
 
     def __init__(self):
-        self.lock = RLock()
+        self.lock = TracedLock(RLock(), "hifi_lock")
 
     def get_outputs(self):
         """
@@ -82,3 +86,265 @@ class HiFi:
         Returns whether this is powered on or not
         """
         return False
+
+
+class ObservedHiFi(HiFi):
+    """
+    Wraps a HiFi backend and calls listeners with the new state whenever a
+    call made through the wrapper changes it. Anything not part of the HiFi
+    interface is passed through to the backend.
+    """
+
+    def __init__(self, hifi):
+        self.hifi = hifi
+        self.lock = hifi.lock
+        self.listeners = []
+        self._state = self.state()
+        # Incremented on every state change, so readers can tell whether
+        # anything has changed since they last looked
+        self.version = 0
+
+    def __getattr__(self, name):
+        return getattr(self.hifi, name)
+
+    def add_listener(self, listener):
+        """
+        Register listener(state, changed), where changed is the set of keys
+        in state which differ from the previous notification
+        """
+        self.listeners.append(listener)
+
+    def state(self):
+        return {
+            "power": self.hifi.is_on(),
+            "muted": self.hifi.muted(),
+            "volume": self.hifi.get_volume(),
+            "output": self.hifi.get_output(),
+        }
+
+    def _update(self):
+        with self.lock:
+            state = self.state()
+            changed = {k for k, v in state.items() if self._state.get(k) != v}
+            self._state = state
+            if len(changed) > 0:
+                self.version += 1
+        if len(changed) > 0:
+            for listener in self.listeners:
+                listener(state, changed)
+
+    def get_outputs(self):
+        return self.hifi.get_outputs()
+
+    def set_output(self, output):
+        with self.lock:
+            self.hifi.set_output(output)
+            self._update()
+
+    def get_output(self):
+        return self.hifi.get_output()
+
+    def set_volume(self, level):
+        with self.lock:
+            self.hifi.set_volume(level)
+            self._update()
+
+    def get_volume(self):
+        return self.hifi.get_volume()
+
+    def adjust_volume(self, adjustment):
+        with self.lock:
+            ret = self.hifi.adjust_volume(adjustment)
+            self._update()
+            return ret
+
+    def mute(self, muted):
+        with self.lock:
+            self.hifi.mute(muted)
+            self._update()
+
+    def muted(self):
+        return self.hifi.muted()
+
+    def turn_on(self):
+        with self.lock:
+            self.hifi.turn_on()
+            self._update()
+
+    def turn_off(self):
+        with self.lock:
+            self.hifi.turn_off()
+            self._update()
+
+    def is_on(self):
+        return self.hifi.is_on()
+
+
+class AsyncHiFi:
+    """
+    Base class for HiFi units driven from an asyncio event loop. Methods
+    which change state are coroutines; the getters are cheap and stay
+    synchronous.
+    """
+
+    def __init__(self):
+        self._lock = None
+
+    @property
+    def lock(self):
+        # Created on first use so that it belongs to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def get_outputs(self):
+        return []
+
+    async def set_output(self, output):
+        pass
+
+    def get_output(self):
+        return None
+
+    async def set_volume(self, level):
+        pass
+
+    def get_volume(self):
+        return 0.0
+
+    async def adjust_volume(self, adjustment):
+        return 0.0
+
+    async def mute(self, muted):
+        pass
+
+    def muted(self):
+        return False
+
+    async def toggle_mute(self):
+        await self.mute(not self.muted())
+
+    async def turn_on(self):
+        pass
+
+    async def turn_off(self):
+        pass
+
+    def is_on(self):
+        return False
+
+
+class SyncHiFiAdapter(AsyncHiFi):
+    """
+    Makes a blocking HiFi backend usable as an AsyncHiFi. Calls which change
+    state run one at a time on a dedicated worker thread, so the event loop
+    is never blocked and the backend sees no more concurrency than before.
+    """
+
+    def __init__(self, hifi):
+        super().__init__()
+        self.hifi = hifi
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __getattr__(self, name):
+        return getattr(self.hifi, name)
+
+    def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self.executor, fn, *args)
+
+    def get_outputs(self):
+        return self.hifi.get_outputs()
+
+    async def set_output(self, output):
+        await self._run(self.hifi.set_output, output)
+
+    def get_output(self):
+        return self.hifi.get_output()
+
+    async def set_volume(self, level):
+        await self._run(self.hifi.set_volume, level)
+
+    def get_volume(self):
+        return self.hifi.get_volume()
+
+    async def adjust_volume(self, adjustment):
+        return await self._run(self.hifi.adjust_volume, adjustment)
+
+    async def mute(self, muted):
+        await self._run(self.hifi.mute, muted)
+
+    def muted(self):
+        return self.hifi.muted()
+
+    async def toggle_mute(self):
+        await self._run(self.hifi.toggle_mute)
+
+    async def turn_on(self):
+        await self._run(self.hifi.turn_on)
+
+    async def turn_off(self):
+        await self._run(self.hifi.turn_off)
+
+    def is_on(self):
+        return self.hifi.is_on()
+
+
+class LoopHiFi(HiFi):
+    """
+    Runs an AsyncHiFi on its own event loop thread and presents it as a
+    blocking HiFi, so it can be wrapped in ObservedHiFi and driven by the
+    API, remotes and inputs like any other backend. Every state change goes
+    through the one loop; callers block until theirs is done.
+    """
+
+    def __init__(self, hifi):
+        super().__init__()
+        self.hifi = hifi
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(
+            target=self.loop.run_forever, name="hifi-loop", daemon=True
+        )
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.hifi, name)
+
+    def _run(self, fn, *args):
+        return asyncio.run_coroutine_threadsafe(fn(*args), self.loop).result()
+
+    def get_outputs(self):
+        return self.hifi.get_outputs()
+
+    def set_output(self, output):
+        self._run(self.hifi.set_output, output)
+
+    def get_output(self):
+        return self.hifi.get_output()
+
+    def set_volume(self, level):
+        self._run(self.hifi.set_volume, level)
+
+    def get_volume(self):
+        return self.hifi.get_volume()
+
+    def adjust_volume(self, adjustment):
+        return self._run(self.hifi.adjust_volume, adjustment)
+
+    def mute(self, muted):
+        self._run(self.hifi.mute, muted)
+
+    def muted(self):
+        return self.hifi.muted()
+
+    def toggle_mute(self):
+        self._run(self.hifi.toggle_mute)
+
+    def turn_on(self):
+        self._run(self.hifi.turn_on)
+
+    def turn_off(self):
+        self._run(self.hifi.turn_off)
+
+    def is_on(self):
+        return self.hifi.is_on()
@@ -2,11 +2,24 @@
 
 import argparse
 import logging
+import os
+import signal
 import sys
+import tempfile
+import time
+
+import gevent
 
 import pyhifid.backends
-from pyhifid.powermate import create_powermate, RemoteInfo
+from pyhifid.backends.utils.wear import DEFAULT_PATH as DEFAULT_WEAR_FILE
+from pyhifid.powermate import RemoteManager, RemoteInfo
 from pyhifid.api import serve_api
+from pyhifid.control import ControlServer
+from pyhifid.gpio_input import ACTIONS, GpioInputs
+from pyhifid.hifi import LoopHiFi, ObservedHiFi, SyncHiFiAdapter
+from pyhifid import capture
+from pyhifid import diagnostics
+from pyhifid import trace
 
 
 def main():
@@ -14,6 +27,12 @@ def main():
     parser.add_argument(
         "--backend", action="store", default="?", help="Backend to use; ? for list"
     )
+    parser.add_argument(
+        "--async_backend",
+        action="store_true",
+        help="drive the backend from an asyncio event loop; backends without "
+        + "an async implementation run through SyncHiFiAdapter",
+    )
     parser.add_argument(
         "--powermate_addr",
         action="append",
@@ -21,13 +40,109 @@ def main():
         metavar="ADDR",
         help="BT address of Griffin Powermate",
     )
+    parser.add_argument(
+        "--backend_opt",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="option passed to the backend, e.g. relay_timing=FILE; "
+        + "PhirePreamp keeps relay wear counts in wear_file=FILE (default "
+        + f"{DEFAULT_WEAR_FILE}; empty to keep them in memory, reset on restart)",
+    )
     parser.add_argument(
         "--log", default="warning", action="store", help="change log level"
     )
+    parser.add_argument(
+        "--unix_socket",
+        action="store",
+        metavar="PATH",
+        help="also serve the API on a Unix domain socket at PATH",
+    )
+    parser.add_argument(
+        "--unix_socket_mode",
+        action="store",
+        default="660",
+        metavar="MODE",
+        help="permissions (octal) of the Unix domain socket",
+    )
+    parser.add_argument(
+        "--control_port",
+        action="store",
+        type=int,
+        metavar="PORT",
+        help="serve the line control protocol on TCP port PORT",
+    )
+    parser.add_argument(
+        "--control_socket",
+        action="store",
+        metavar="PATH",
+        help="serve the line control protocol on a Unix domain socket at PATH",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store",
+        metavar="DIR",
+        help="write a Chrome trace of every API request to DIR",
+    )
+    parser.add_argument(
+        "--trace_size",
+        action="store",
+        type=int,
+        default=1024,
+        metavar="N",
+        help="number of recent operations kept for /debug/trace and SIGUSR1",
+    )
+    parser.add_argument(
+        "--gpio_input",
+        action="append",
+        default=[],
+        metavar="NAME=ACTION",
+        help="run ACTION on edges of GPIO line NAME (!NAME if active low); "
+        + "actions: "
+        + ", ".join(ACTIONS.keys()),
+    )
+    parser.add_argument(
+        "--gpio_debounce",
+        action="store",
+        type=float,
+        default=0.02,
+        metavar="SECONDS",
+        help="debounce period for --gpio_input lines",
+    )
+    parser.add_argument(
+        "--record",
+        action="store",
+        metavar="FILE",
+        help="capture API requests and Powermate events to FILE for pyhifid-replay",
+    )
+    parser.add_argument(
+        "--diagnostics",
+        action="store_true",
+        help="serve memory, thread and handle diagnostics under /debug",
+    )
+    parser.add_argument(
+        "--tracemalloc_frames",
+        action="store",
+        type=int,
+        default=1,
+        metavar="N",
+        help="frames of traceback kept per allocation with --diagnostics",
+    )
     args = parser.parse_args()
 
     logging.basicConfig(level=args.log.upper())
 
+    trace.RECORDER.resize(args.trace_size)
+
+    if args.record is not None:
+        capture.start(args.record)
+
+    # Start tracing early so allocations made during startup are attributed
+    allocations = None
+    if args.diagnostics:
+        allocations = diagnostics.Allocations(frames=args.tracemalloc_frames)
+        allocations.start()
+
     if args.backend == "?":
         print("Valid backends:")
         for k, v in pyhifid.backends.BACKENDS.items():
@@ -39,19 +154,76 @@ def main():
 
     # Almost certainly not the most pythonic way to do this,
     # but it's what  I came up with:
-    name = pyhifid.backends.BACKENDS[args.backend]
+    native_async = (
+        args.async_backend and args.backend in pyhifid.backends.ASYNC_BACKENDS
+    )
+    if native_async:
+        name = pyhifid.backends.ASYNC_BACKENDS[args.backend]
+    else:
+        name = pyhifid.backends.BACKENDS[args.backend]
     target = __import__(".".join(name.split(".")[:-1]))
     for component in name.split(".")[1:]:
         target = getattr(target, component)
 
-    hifi = target()
+    backend_opts = {}
+    for opt in args.backend_opt:
+        key, sep, value = opt.partition("=")
+        if sep == "":
+            raise RuntimeError(f"invalid backend option: {opt}")
+        backend_opts[key] = value
+
+    backend = target(**backend_opts)
+    if args.async_backend:
+        if not native_async:
+            backend = SyncHiFiAdapter(backend)
+        backend = LoopHiFi(backend)
+    hifi = ObservedHiFi(backend)
 
     remote_info = RemoteInfo()
-    powermates = []
+    remotes = RemoteManager(hifi, remote_info)
     for addr in args.powermate_addr:
-        powermates.append(create_powermate(addr, hifi, remote_info))
+        remotes.add_remote(addr)
+    if len(args.powermate_addr) > 0:
+        remotes.start()
+
+    if len(args.gpio_input) > 0:
+        inputs = GpioInputs(hifi, debounce=args.gpio_debounce)
+        for spec in args.gpio_input:
+            inputs.add(spec)
+        inputs.start()
 
-    serve_api(hifi, remote_info)
+    if args.control_port is not None or args.control_socket is not None:
+        control = ControlServer(
+            hifi,
+            port=args.control_port,
+            unix_socket=args.control_socket,
+            unix_socket_mode=int(args.unix_socket_mode, 8),
+        )
+        control.start()
+
+    def dump_trace():
+        name = f"pyhifid-trace-{os.getpid()}-{time.time():.0f}.json"
+        path = os.path.join(tempfile.gettempdir(), name)
+        try:
+            trace.RECORDER.dump_to_file(path)
+        except OSError as e:
+            logging.getLogger(__name__).error(f"flight recorder dump failed: {e}")
+            return
+        logging.getLogger(__name__).warning(f"flight recorder dumped to {path}")
+
+    gevent.signal_handler(signal.SIGUSR1, dump_trace)
+
+    if args.profile is not None:
+        os.makedirs(args.profile, exist_ok=True)
+
+    serve_api(
+        hifi,
+        remote_info,
+        profile_dir=args.profile,
+        unix_socket=args.unix_socket,
+        unix_socket_mode=int(args.unix_socket_mode, 8),
+        allocations=allocations,
+    )
 
 
 if __name__ == "__main__":
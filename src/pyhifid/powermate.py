@@ -2,63 +2,135 @@
 
 import datetime
 import logging
+import select
+import struct
 import time
 from threading import Lock, Thread
-from powermate import Powermate, PowermateDelegate
+from powermate import (
+    PowermateDelegate,
+    BATTERY_CC_HND,
+    BATTERY_VAL_HND,
+    KNOB_CC_HND,
+    KNOB_VAL_HND,
+)
+from pyhifid import capture
+from pyhifid.blelink import BleLink, LinkError
+from pyhifid import telemetry
+from pyhifid.trace import record
 
 
 class RemoteInfo:
-    def __init__(self):
+    """
+    Latest state of each remote, plus a bounded history of battery level,
+    connect/disconnect and event-rate samples
+    """
+
+    def __init__(self, history_size=4096, rate_interval=60.0):
         self.info = {}
+        self.history_size = history_size
+        self.rate_interval = rate_interval
+        self.rings = {}
+        self.events = {}
+        self.next_rate_sample = time.monotonic() + rate_interval
+        # Incremented whenever the info or history of any remote changes
+        self.version = 0
+
+    def _ring(self, addr):
+        if addr not in self.rings:
+            self.rings[addr] = telemetry.SampleRing(self.history_size)
+            self.events[addr] = 0
+            self.version += 1
+        return self.rings[addr]
+
+    def _update(self, addr, **kwargs):
+        self.info.setdefault(addr, {}).update(kwargs)
+        self.version += 1
 
     def battery_report(self, addr, val):
-        self.info[addr] = {
-            "battery_level": val,
-            "report_time": datetime.datetime.now().isoformat(),
-        }
+        self._ring(addr).append(telemetry.BATTERY, val)
+        self._update(
+            addr,
+            battery_level=val,
+            report_time=datetime.datetime.now().isoformat(),
+        )
+
+    def connected(self, addr):
+        self._ring(addr).append(telemetry.CONNECT, 1)
+        self._update(addr, connected=True)
+
+    def disconnected(self, addr):
+        self._ring(addr).append(telemetry.DISCONNECT, 1)
+        self._update(addr, connected=False)
+
+    def event(self, addr):
+        self._ring(addr)
+        self.events[addr] += 1
+
+    def tick(self):
+        """
+        Record the event rate (events/minute) of each remote which has seen
+        events since the last sample; should be called at least once a second
+        """
+        now = time.monotonic()
+        if now < self.next_rate_sample:
+            return
+        elapsed = now - self.next_rate_sample + self.rate_interval
+        self.next_rate_sample = now + self.rate_interval
+        for addr, count in self.events.items():
+            if count > 0:
+                self.rings[addr].append(telemetry.EVENT_RATE, count * 60.0 / elapsed)
+                self.events[addr] = 0
+                self.version += 1
 
     def get_info(self):
         return self.info
 
+    def history(self, addr, start=None, end=None, kind=None, step=None):
+        if addr not in self.rings:
+            return None
+        if kind is not None:
+            kind = telemetry.KINDS[kind]
+        return self.rings[addr].query(start, end, kind, step)
+
 
 class PowermatePreamp(PowermateDelegate):
-    def __init__(self, addr, hifi, info):
+    def __init__(self, addr, hifi, info, manager):
         self.addr = addr
         self.hifi = hifi
         self.info = info
+        self.manager = manager
         self.logger = logging.getLogger(__name__)
-        self.lock = Lock()
-        self.last = datetime.datetime.now()
-        self.adjust = 0
-
-        def adjust_thread():
-            while True:
-                with self.lock:
-                    if self.adjust != 0:
-                        self.hifi.adjust_volume(self.adjust)
-                        self.adjust = 0
-                time.sleep(0.05)
-
-        self.thread = Thread(target=adjust_thread)
-        self.thread.start()
+
+    def _record(self, event, **args):
+        record(f"powermate_{event}", addr=self.addr, **args)
+        capture.write("powermate", addr=self.addr, e=event, a=list(args.values()))
 
     def on_connect(self):
         self.logger.debug("powermate connected")
+        self._record("connect")
+        self.info.connected(self.addr)
 
     def on_disconnect(self):
         self.logger.debug("powermate disconnnected")
+        self._record("disconnect")
+        self.info.disconnected(self.addr)
 
     def on_battery_report(self, val):
         self.logger.debug(f"powermate battery: {val}%")
+        self._record("battery_report", val=val)
         self.info.battery_report(self.addr, val)
 
     def on_press(self):
         self.logger.debug("powermate button pressed")
+        self._record("press")
+        self.info.event(self.addr)
         self.hifi.toggle_mute()
 
     def on_long_press(self, t):
         self.logger.debug(f"powermate button long pressed for {t} seconds")
-        with self.lock:
+        self._record("long_press", t=t)
+        self.info.event(self.addr)
+        with self.hifi.lock:
             if self.hifi.is_on():
                 self.hifi.turn_off()
             else:
@@ -66,16 +138,18 @@ class PowermatePreamp(PowermateDelegate):
 
     def on_clockwise(self):
         self.logger.debug("powermate clockwise")
-        with self.lock:
-            self.adjust += 1
+        self._record("clockwise")
+        self.info.event(self.addr)
+        self.manager.queue_adjust(self.addr, 1)
 
     def on_counterclockwise(self):
         self.logger.debug("powermate counterclockwise")
-        with self.lock:
-            self.adjust += -1
+        self._record("counterclockwise")
+        self.info.event(self.addr)
+        self.manager.queue_adjust(self.addr, -1)
 
     def _adjust_output(self, direction):
-        with self.lock:
+        with self.hifi.lock:
             outputs = self.hifi.get_outputs()
             output = self.hifi.get_output()
             if output not in outputs:
@@ -86,12 +160,237 @@ class PowermatePreamp(PowermateDelegate):
 
     def on_press_clockwise(self):
         self.logger.debug("powermate press clockwise")
+        self._record("press_clockwise")
+        self.info.event(self.addr)
         self._adjust_output(1)
 
     def on_press_counterclockwise(self):
         self.logger.debug("powermate press counterclockwise")
+        self._record("press_counterclockwise")
+        self.info.event(self.addr)
         self._adjust_output(-1)
 
 
-def create_powermate(addr, hifi, info):
-    return Powermate(addr, PowermatePreamp(addr, hifi, info))
+class KnobDecoder:
+    """
+    Turns Powermate notifications into PowermateDelegate calls
+    """
+
+    def __init__(self, delegate):
+        self.delegate = delegate
+        self.long_press = 0
+        self.logger = logging.getLogger(__name__)
+
+    def __call__(self, handle, data):
+        # A failing callback (e.g. a backend error) mustn't stop the
+        # remaining notifications, or the remote thread, from being handled
+        try:
+            val = struct.unpack("b", data)[0]
+            if handle == KNOB_VAL_HND:
+                self._knob(val)
+            elif handle == BATTERY_VAL_HND:
+                self.delegate.on_battery_report(val)
+        except Exception:
+            self.logger.exception(f"{self.delegate.addr}: handling {data} failed")
+
+    def _knob(self, val):
+        if val == 104:
+            self.delegate.on_clockwise()
+        elif val == 103:
+            self.delegate.on_counterclockwise()
+        elif val == 101:
+            self.delegate.on_press()
+        elif val == 112:
+            self.delegate.on_press_clockwise()
+        elif val == 105:
+            self.delegate.on_press_counterclockwise()
+        elif 114 <= val <= 119:
+            self.long_press = val - 113
+        elif val == 102 and self.long_press > 0:
+            self.delegate.on_long_press(self.long_press)
+            self.long_press = 0
+
+
+class Remote:
+    """
+    Connection state for a single remote managed by RemoteManager. link is
+    None between connection attempts, and up once the remote has connected.
+    """
+
+    def __init__(self, addr, delegate):
+        self.addr = addr
+        self.delegate = delegate
+        self.link = None
+        self.up = False
+        self.backoff = 0.0
+        self.next_attempt = 0.0
+        self.pending = 0
+
+    def fileno(self):
+        return self.link.fileno()
+
+
+class RemoteManager:
+    """
+    Drives every Powermate remote from a single thread.
+
+    Each remote is connected through its own bluepy-helper; connection
+    attempts and notifications from all remotes are multiplexed with
+    select(), so nothing blocks the thread. Failed connections are retried
+    with exponential backoff, and knob rotations from every remote are merged
+    into a single pending volume adjustment which is applied at most once per
+    adjust_interval. Each remote may contribute at most max_step to a single
+    adjustment.
+    """
+
+    def __init__(
+        self,
+        hifi,
+        info,
+        iface=None,
+        adjust_interval=0.05,
+        max_step=8,
+        min_backoff=1.0,
+        max_backoff=60.0,
+        connect_timeout=10.0,
+    ):
+        self.hifi = hifi
+        self.info = info
+        self.iface = iface
+        self.adjust_interval = adjust_interval
+        self.max_step = max_step
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.connect_timeout = connect_timeout
+        self.logger = logging.getLogger(__name__)
+
+        self.lock = Lock()
+        self.remotes = {}
+        self.kill = False
+        self.thread = Thread(target=self._run, name="powermate", daemon=True)
+
+    def add_remote(self, addr):
+        delegate = PowermatePreamp(addr, self.hifi, self.info, self)
+        with self.lock:
+            self.remotes[addr] = Remote(addr, delegate)
+        return delegate
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.kill = True
+        self.thread.join()
+        for remote in self.remotes.values():
+            if remote.link is not None:
+                remote.link.close()
+
+    def queue_adjust(self, addr, delta):
+        with self.lock:
+            remote = self.remotes[addr]
+            pending = remote.pending + delta
+            remote.pending = max(-self.max_step, min(self.max_step, pending))
+
+    def _take_adjust(self):
+        with self.lock:
+            adjust = 0
+            for remote in self.remotes.values():
+                adjust += remote.pending
+                remote.pending = 0
+            return adjust
+
+    def _connect(self, remote):
+        self.logger.debug(f"connecting to {remote.addr}")
+        try:
+            remote.link = BleLink(
+                remote.addr,
+                KnobDecoder(remote.delegate),
+                notify=(BATTERY_CC_HND, KNOB_CC_HND),
+                iface=self.iface,
+                connect_timeout=self.connect_timeout,
+            )
+        except (OSError, LinkError) as e:
+            self._failed(remote, e)
+
+    def _failed(self, remote, e):
+        if remote.link is not None:
+            remote.link.close()
+            remote.link = None
+
+        if remote.up:
+            self.logger.debug(f"{remote.addr}: {e}")
+            remote.up = False
+            remote.next_attempt = time.monotonic() + self.min_backoff
+            remote.delegate.on_disconnect()
+            return
+
+        remote.backoff = min(
+            max(remote.backoff * 2, self.min_backoff), self.max_backoff
+        )
+        remote.next_attempt = time.monotonic() + remote.backoff
+        self.logger.debug(
+            f"{remote.addr}: {e}; retrying in {remote.backoff:.1f} seconds"
+        )
+
+    def _service(self, remote):
+        try:
+            remote.link.read()
+        except LinkError as e:
+            self._failed(remote, e)
+            return
+
+        if remote.link.connected and not remote.up:
+            remote.up = True
+            remote.backoff = 0.0
+            remote.delegate.on_connect()
+
+    def _run(self):
+        next_adjust = 0.0
+        while not self.kill:
+            self.info.tick()
+            now = time.monotonic()
+            remotes = list(self.remotes.values())
+            for remote in remotes:
+                if remote.link is None and now >= remote.next_attempt:
+                    self._connect(remote)
+                elif remote.link is not None and not remote.up:
+                    if now >= remote.link.deadline:
+                        self._failed(remote, "connect timed out")
+
+            pending = any(r.pending != 0 for r in remotes)
+            now = time.monotonic()
+            if pending and now >= next_adjust:
+                adjust = self._take_adjust()
+                if adjust != 0:
+                    record("powermate_adjust", adjust=adjust)
+                    try:
+                        self.hifi.adjust_volume(adjust)
+                    except Exception:
+                        self.logger.exception(f"adjusting volume by {adjust} failed")
+                next_adjust = now + self.adjust_interval
+                pending = False
+
+            # Sleep until there's something to do: helper output, a merged
+            # adjustment to apply, or a connection attempt to start or give
+            # up on.
+            deadlines = [now + 1.0]
+            if pending:
+                deadlines.append(next_adjust)
+            for r in remotes:
+                if r.link is None:
+                    deadlines.append(r.next_attempt)
+                elif not r.up:
+                    deadlines.append(r.link.deadline)
+            timeout = max(0.0, min(deadlines) - time.monotonic())
+
+            linked = [r for r in remotes if r.link is not None]
+            if len(linked) == 0:
+                time.sleep(timeout)
+                continue
+
+            readable, _, _ = select.select(linked, [], [], timeout)
+            for remote in readable:
+                try:
+                    self._service(remote)
+                except Exception:
+                    self.logger.exception(f"{remote.addr}: servicing remote failed")
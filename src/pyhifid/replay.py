@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Plays back a capture made with `pyhifid --record` against MockHiFi or the
+simulated PhirePreamp, at the original or an accelerated speed, and reports
+how long each kind of request took and how much relay activity the workload
+caused.
+
+API requests go through the same Flask app as the daemon (without the
+network), and Powermate events through the same delegate and merged volume
+adjustment as a connected remote.
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import sys
+import time
+
+import pyhifid.backends
+from pyhifid import api
+from pyhifid import capture
+from pyhifid.hifi import LoopHiFi, ObservedHiFi
+from pyhifid.powermate import RemoteInfo, RemoteManager
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ReplayRemotes(RemoteManager):
+    """
+    RemoteManager without Bluetooth: events are passed straight to the
+    delegates, and the replay loop applies merged adjustments with flush()
+    """
+
+    def __init__(self, hifi, info):
+        super().__init__(hifi, info)
+        self.next_adjust = 0.0
+
+    def delegate(self, addr):
+        if addr not in self.remotes:
+            self.add_remote(addr)
+        return self.remotes[addr].delegate
+
+    def next_flush(self):
+        """
+        When the pending adjustment is due, or None if there isn't one
+        """
+        if all(r.pending == 0 for r in self.remotes.values()):
+            return None
+        return self.next_adjust
+
+    def flush(self):
+        adjust = self._take_adjust()
+        if adjust != 0:
+            self.hifi.adjust_volume(adjust)
+        self.next_adjust = time.perf_counter() + self.adjust_interval
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.max_lag = 0.0
+        self.duration = 0.0
+
+    def add(self, name, latency, error=False):
+        self.latencies.setdefault(name, []).append(latency)
+        if error:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def summary(self):
+        ret = {}
+        for name, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            n = len(latencies)
+
+            def percentile(p):
+                return latencies[int(round(p * (n - 1)))] * 1000
+
+            ret[name] = {
+                "count": n,
+                "errors": self.errors.get(name, 0),
+                "mean_ms": sum(latencies) / n * 1000,
+                "p50_ms": percentile(0.5),
+                "p95_ms": percentile(0.95),
+                "p99_ms": percentile(0.99),
+                "max_ms": latencies[-1] * 1000,
+            }
+        return ret
+
+
+def timed(stats, name, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        ret = fn(*args, **kwargs)
+    except Exception as e:
+        _LOGGER.warning(f"{name}: {e}")
+        stats.add(name, time.perf_counter() - start, error=True)
+        return None
+    stats.add(name, time.perf_counter() - start)
+    return ret
+
+
+def sleep_until(t):
+    delay = t - time.perf_counter()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def replay(entries, hifi, speed=1.0):
+    """
+    Replay captured entries against hifi (an ObservedHiFi), returning Stats
+    """
+    info = RemoteInfo()
+    remotes = ReplayRemotes(hifi, info)
+    client = api.create_app(hifi, info).test_client()
+    stats = Stats()
+
+    start = time.perf_counter()
+    for entry in entries:
+        if entry["k"] == "start":
+            continue
+        due = start + entry["t"] / speed
+
+        # Apply knob adjustments which fall due before this entry
+        flush = remotes.next_flush()
+        while flush is not None and flush <= due:
+            sleep_until(flush)
+            timed(stats, "powermate adjust", remotes.flush)
+            flush = remotes.next_flush()
+
+        sleep_until(due)
+        stats.max_lag = max(stats.max_lag, time.perf_counter() - due)
+
+        if entry["k"] == "api":
+            name = f"{entry['m']} {entry['p']}"
+            if entry["m"] == "GET":
+                request = (client.get, entry["p"])
+                kwargs = {"query_string": entry["a"]}
+            else:
+                request = (client.open, entry["p"])
+                kwargs = {"method": entry["m"], "data": entry["a"]}
+            resp = timed(stats, name, *request, **kwargs)
+            if resp is not None and resp.status_code >= 400:
+                stats.errors[name] = stats.errors.get(name, 0) + 1
+        elif entry["k"] == "powermate":
+            delegate = remotes.delegate(entry["addr"])
+            callback = getattr(delegate, "on_" + entry["e"])
+            timed(stats, f"powermate {entry['e']}", callback, *entry["a"])
+
+    if remotes.next_flush() is not None:
+        sleep_until(remotes.next_flush())
+        timed(stats, "powermate adjust", remotes.flush)
+
+    stats.duration = time.perf_counter() - start
+    return stats
+
+
+def create_backend(name, opts, use_async=False):
+    if use_async:
+        path = pyhifid.backends.ASYNC_BACKENDS[name]
+    else:
+        path = pyhifid.backends.BACKENDS[name]
+    module, _, cls = path.rpartition(".")
+    backend = getattr(importlib.import_module(module), cls)(**opts)
+    return LoopHiFi(backend) if use_async else backend
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a pyhifid capture and report latency and relay usage"
+    )
+    parser.add_argument("capture", help="file written by pyhifid --record")
+    parser.add_argument(
+        "--backend",
+        choices=["MockHiFi", "SimulatedPhirePreamp"],
+        default="SimulatedPhirePreamp",
+    )
+    parser.add_argument(
+        "--backend_opt",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="option passed to the backend, e.g. gpio_latency=0.001",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="drive the backend's async implementation from an event loop",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="playback speed; 10 replays ten times faster than captured",
+    )
+    parser.add_argument(
+        "--json", action="store_true", help="print the report as JSON"
+    )
+    parser.add_argument(
+        "--log", default="warning", action="store", help="change log level"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log.upper())
+
+    backend_opts = {}
+    for opt in args.backend_opt:
+        key, sep, value = opt.partition("=")
+        if sep == "":
+            raise RuntimeError(f"invalid backend option: {opt}")
+        backend_opts[key] = value
+
+    backend = create_backend(args.backend, backend_opts, use_async=args.use_async)
+    hifi = ObservedHiFi(backend)
+    # API entries are written when the request finishes but timestamped when
+    # it started, so the file isn't quite in time order
+    entries = sorted(capture.read(args.capture), key=lambda e: e["t"])
+
+    before = backend.sim_stats()["gpio"] if hasattr(backend, "sim_stats") else None
+    stats = replay(entries, hifi, speed=args.speed)
+
+    report = {
+        "entries": len(entries) - 1,
+        "captured_s": entries[-1]["t"] if len(entries) > 0 else 0.0,
+        "replayed_s": stats.duration,
+        "max_lag_ms": stats.max_lag * 1000,
+        "latency": stats.summary(),
+    }
+    if before is not None:
+        after = backend.sim_stats()["gpio"]
+        report["hardware"] = {k: after[k] - before[k] for k in after}
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+        return 0
+
+    print(
+        f"{report['entries']} entries, captured over {report['captured_s']:.1f} s, "
+        f"replayed in {report['replayed_s']:.1f} s "
+        f"(max lag {report['max_lag_ms']:.1f} ms)"
+    )
+    print()
+    print(
+        f"{'':32} {'count':>6} {'errors':>6} {'mean':>8} {'p50':>8} "
+        f"{'p95':>8} {'p99':>8} {'max':>8}"
+    )
+    for name, s in report["latency"].items():
+        print(
+            f"{name:32} {s['count']:6} {s['errors']:6} {s['mean_ms']:8.2f} "
+            f"{s['p50_ms']:8.2f} {s['p95_ms']:8.2f} {s['p99_ms']:8.2f} "
+            f"{s['max_ms']:8.2f}"
+        )
+    if "hardware" in report:
+        print()
+        for k, v in report["hardware"].items():
+            print(f"{k:32} {v:6}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class Handle:
+    """
+    A scheduled call, which can be cancelled until it has started running
+    """
+
+    def __init__(self, scheduler, when, name, fn, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        """
+        Returns True if the call was cancelled before it ran
+        """
+        return self.scheduler.cancel(self)
+
+    def remaining(self):
+        return max(self.when - self.scheduler.clock(), 0.0)
+
+    def active(self):
+        return not self.cancelled and not self.done
+
+
+class Scheduler:
+    """
+    Runs deferred calls in deadline order on a single worker thread, however
+    many are pending. Deadlines are on the monotonic clock, so they aren't
+    affected by changes to the wall clock.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, fn, *args, name=None):
+        return self.call_at(self.clock() + delay, fn, *args, name=name)
+
+    def call_at(self, when, fn, *args, name=None):
+        if not math.isfinite(when):
+            raise ValueError(f"invalid deadline: {when}")
+        handle = Handle(self, when, name or fn.__name__, fn, args)
+        with self.cond:
+            heapq.heappush(self.heap, (when, next(self.seq), handle))
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._run, name="scheduler", daemon=True
+                )
+                self.thread.start()
+            self.cond.notify()
+        return handle
+
+    def cancel(self, handle):
+        with self.cond:
+            if not handle.active():
+                return False
+            # Cancelled entries are dropped when they reach the top of the heap
+            handle.cancelled = True
+            self.cond.notify()
+            return True
+
+    def pending(self):
+        """
+        Returns the calls which have yet to run, soonest first
+        """
+        with self.cond:
+            handles = [h for _, _, h in sorted(self.heap) if h.active()]
+        return handles
+
+    def _next(self):
+        with self.cond:
+            while True:
+                while len(self.heap) > 0 and not self.heap[0][2].active():
+                    heapq.heappop(self.heap)
+
+                if len(self.heap) == 0:
+                    self.cond.wait()
+                    continue
+
+                when, _, handle = self.heap[0]
+                delay = when - self.clock()
+                if delay > 0:
+                    # Far-off deadlines are waited for in several steps
+                    self.cond.wait(min(delay, threading.TIMEOUT_MAX))
+                    continue
+
+                heapq.heappop(self.heap)
+                handle.done = True
+                return handle
+
+    def _run(self):
+        while True:
+            try:
+                handle = self._next()
+            except Exception:
+                # Every timer depends on this thread, so it must never die
+                _LOGGER.exception("scheduler failed")
+                time.sleep(1.0)
+                continue
+            try:
+                handle.fn(*handle.args)
+            except Exception:
+                _LOGGER.exception(f"scheduled call {handle.name} failed")
+
+
+SCHEDULER = Scheduler()
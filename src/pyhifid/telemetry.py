@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import array
+import time
+from threading import Lock
+
+BATTERY = 0
+CONNECT = 1
+DISCONNECT = 2
+EVENT_RATE = 3
+
+KINDS = {
+    "battery": BATTERY,
+    "connect": CONNECT,
+    "disconnect": DISCONNECT,
+    "event_rate": EVENT_RATE,
+}
+KIND_NAMES = {v: k for k, v in KINDS.items()}
+
+
+class SampleRing:
+    """
+    Fixed-size ring buffer of (time, kind, value) samples.
+
+    Samples are stored in preallocated arrays (13 bytes per sample), so
+    memory use is bounded by size no matter how long the daemon runs; once
+    the buffer is full the oldest samples are overwritten.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.times = array.array("d", bytes(8 * size))
+        self.kinds = array.array("b", bytes(size))
+        self.values = array.array("f", bytes(4 * size))
+        self.head = 0
+        self.count = 0
+        self.lock = Lock()
+
+    def append(self, kind, value, t=None):
+        if t is None:
+            t = time.time()
+        with self.lock:
+            self.times[self.head] = t
+            self.kinds[self.head] = kind
+            self.values[self.head] = value
+            self.head = (self.head + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def samples(self, start=None, end=None, kind=None):
+        """
+        Returns (time, kind, value) tuples in chronological order
+        """
+        with self.lock:
+            first = (self.head - self.count) % self.size
+            idxs = [(first + i) % self.size for i in range(self.count)]
+            ret = []
+            for i in idxs:
+                t = self.times[i]
+                if start is not None and t < start:
+                    continue
+                if end is not None and t > end:
+                    continue
+                if kind is not None and self.kinds[i] != kind:
+                    continue
+                ret.append((t, self.kinds[i], self.values[i]))
+            return ret
+
+    def query(self, start=None, end=None, kind=None, step=None):
+        """
+        Returns samples as dicts. If step is given, samples of each kind are
+        averaged into buckets of step seconds; "samples" is the number of raw
+        samples that went into each bucket.
+        """
+        samples = self.samples(start, end, kind)
+        if step is None:
+            return [
+                {"time": t, "kind": KIND_NAMES[k], "value": v, "samples": 1}
+                for t, k, v in samples
+            ]
+
+        if start is None:
+            start = samples[0][0] if len(samples) > 0 else 0.0
+
+        buckets = {}
+        for t, k, v in samples:
+            key = (int((t - start) // step), k)
+            total, n = buckets.get(key, (0.0, 0))
+            buckets[key] = (total + v, n + 1)
+
+        return [
+            {
+                "time": start + b * step,
+                "kind": KIND_NAMES[k],
+                "value": total / n,
+                "samples": n,
+            }
+            for (b, k), (total, n) in sorted(buckets.items())
+        ]
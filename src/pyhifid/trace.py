@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+# The trace being recorded. A context variable rather than a thread-local,
+# since API requests are greenlets sharing one thread; gevent gives each
+# greenlet its own context.
+_current = contextvars.ContextVar("trace", default=None)
+
+
+class FlightRecorder:
+    """
+    Always-on ring buffer of the most recent operations (API calls, remote
+    events, relay frames, power transitions, BruteFIR commands). It holds at
+    most size entries, so memory stays fixed however long the daemon runs.
+    """
+
+    def __init__(self, size=1024):
+        self.entries = collections.deque(maxlen=size)
+        # Entries are timestamped with perf_counter(); this converts to
+        # wall-clock time when they are dumped
+        self.offset = time.time() - time.perf_counter()
+
+    def resize(self, size):
+        self.entries = collections.deque(self.entries, maxlen=size)
+
+    def add(self, name, start, end, args):
+        self.entries.append((start, end - start, name, threading.get_ident(), args))
+
+    def dump(self, last=None):
+        entries = list(self.entries)
+        if last is not None:
+            # entries[-0:] would be all of them
+            entries = entries[-last:] if last > 0 else []
+        threads = {t.ident: t.name for t in threading.enumerate()}
+        return [
+            {
+                "time": self.offset + start,
+                "duration": duration,
+                "name": name,
+                "thread": threads.get(tid, tid),
+                "args": args,
+            }
+            for start, duration, name, tid, args in entries
+        ]
+
+    def dump_to_file(self, path):
+        """
+        Dump to a new file at path, which must not exist already (so that
+        it is safe to use in a shared directory such as /tmp)
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+        with os.fdopen(os.open(path, flags, 0o600), "w") as f:
+            json.dump(self.dump(), f, default=str)
+
+
+RECORDER = FlightRecorder()
+
+
+def record(name, **args):
+    """
+    Record an instantaneous event in the flight recorder
+    """
+    now = time.perf_counter()
+    RECORDER.add(name, now, now, args)
+
+
+class Trace:
+    """
+    Timeline of spans recorded while handling a single request
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.wall_start = time.time()
+        self.spans = []
+
+    def add(self, name, start, end, args):
+        self.spans.append((name, start, end, threading.get_ident(), args))
+
+    def server_timing(self):
+        """
+        Render the spans as a Server-Timing header value
+        """
+        entries = []
+        for name, start, end, _, _ in self.spans:
+            entries.append(f"{name};dur={(end - start) * 1000:.3f}")
+        return ", ".join(entries)
+
+    def chrome_trace(self):
+        """
+        Render the spans in Chrome's trace event format, which can be loaded
+        into chrome://tracing or Perfetto
+        """
+        pid = os.getpid()
+        events = []
+        for name, start, end, tid, args in self.spans:
+            events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (self.wall_start + start - self.start) * 1e6,
+                    "dur": (end - start) * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+        return {"traceEvents": events, "otherData": {"request": self.name}}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+def begin(name):
+    """
+    Start recording spans in the current thread or greenlet
+    """
+    trace = Trace(name)
+    _current.set(trace)
+    return trace
+
+
+def end():
+    """
+    Stop recording spans in the current thread or greenlet and return the
+    trace
+    """
+    trace = _current.get()
+    _current.set(None)
+    return trace
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """
+    Record the duration of the enclosed block in the flight recorder, and in
+    the current trace if one is active
+    """
+    trace = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        RECORDER.add(name, start, end, args)
+        if trace is not None:
+            trace.add(name, start, end, args)
+
+
+class TracedLock:
+    """
+    Wrapper around a lock which records a span whenever acquiring it has to
+    wait for another holder
+    """
+
+    def __init__(self, lock, name):
+        self._lock = lock
+        self.name = name
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(blocking=False):
+            return True
+        if not blocking:
+            return False
+        with span(f"{self.name}_wait"):
+            return self._lock.acquire(timeout=timeout)
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()